@@ -14,9 +14,7 @@
 #
 
 import argparse
-import glob
 import os
-import shutil
 import utils
 
 
@@ -46,6 +44,14 @@ def get_parser():
         help='Path to the BIDS-compliant folder where manually corrected files will be copied. Example: '
              '~/<output_dataset>/derivatives/labels'
     )
+    parser.add_argument(
+        '-jobs',
+        metavar="<int>",
+        type=utils.positive_int,
+        default=16,
+        help='Number of files copied in parallel. Use 1 to copy files sequentially (e.g., for debugging). '
+             'Default: 16'
+    )
 
     return parser
 
@@ -68,27 +74,8 @@ def main():
     else:
         raise NotADirectoryError(f'{args.path_out} does not exist.')
 
-    # Loop across files in input dataset
-    for path_file_in in sorted(glob.glob(path_in + '/**/*.nii.gz', recursive=True)):
-        sub, ses, filename, contrast = utils.fetch_subject_and_session(path_file_in)
-        # Construct path for the output file
-        path_file_out = os.path.join(path_out, sub, ses, contrast, filename)
-        # Check if subject's folder exists in the output dataset, if not, create it
-        path_subject_folder_out = os.path.join(path_out, sub, ses, contrast)
-        if not os.path.isdir(path_subject_folder_out):
-            os.makedirs(path_subject_folder_out)
-            print(f'Creating directory: {path_subject_folder_out}')
-        # Copy nii and json files to the output dataset
-        # TODO - consider rsync instead of shutil.copy
-        shutil.copy(path_file_in, path_file_out)
-        print(f'Copying: {path_file_in} to {path_file_out}')
-        path_file_json_in = path_file_in.replace('nii.gz', 'json')
-        path_file_json_out = path_file_out.replace('nii.gz', 'json')
-        if os.path.isfile(path_file_json_in):
-            shutil.copy(path_file_json_in, path_file_json_out)
-            print(f'Copying: {path_file_json_in} to {path_file_json_out}')
-        else:
-            print(f'Warning: {path_file_json_in} does not exist.')
+    # Copy nii and json files to the output dataset
+    utils.copy_labels_to_derivatives(path_in, path_out, jobs=args.jobs)
 
 
 if __name__ == '__main__':
@@ -16,23 +16,125 @@
 #
 
 import argparse
+import atexit
+import functools
 import tempfile
 import coloredlogs
-import glob
+import fnmatch
 import json
 import os
+import re
 import logging
 import sys
 import shutil
+from copy import deepcopy
 from textwrap import dedent
 import time
 import tqdm
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import utils
 
-import numpy as np
-import nibabel as nib
+# Use orjson (much faster JSON parser) if available, otherwise fall back to the standard json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Examples shown in the help of the '-config' and '-json-metadata' flags
+YAML_EXAMPLE = dedent(
+    """
+    FILES_SEG:
+    - sub-001_T1w.nii.gz
+    - sub-002_T2w.nii.gz
+    FILES_GMSEG:
+    - sub-001_T1w.nii.gz
+    - sub-002_T2w.nii.gz
+    FILES_LESION:
+    - sub-001_T1w.nii.gz
+    - sub-002_T2w.nii.gz
+    FILES_LABEL:
+    - sub-001_T1w.nii.gz
+    - sub-002_T1w.nii.gz
+    FILES_COMPRESSION:
+    - sub-001_T1w.nii.gz
+    - sub-002_T1w.nii.gz
+    FILES_PMJ:
+    - sub-001_T1w.nii.gz
+    - sub-002_T1w.nii.gz
+    FILES_ROOTLETS:
+    - sub-001_T1w.nii.gz
+    - sub-002_T1w.nii.gz
+    FILES_CENTERLINE:
+    - sub-001_T1w.nii.gz
+    - sub-002_T1w.nii.gz\n
+    """)
+
+JSON_EXAMPLE = dedent(
+    """
+    {
+       "Name": "sct_deepseg_sc",
+       "Version": "SCT v6.2",
+       "Date": "yyyy-mm-dd hh:mm:ss"
+    }\n
+    """)
+
+# SCT function used to generate the QC report for each task
+QC_FUNCTIONS = {
+    'FILES_SEG': 'sct_deepseg_sc',
+    'FILES_GMSEG': 'sct_deepseg_gm',
+    'FILES_LABEL': 'sct_label_utils',
+    # Note: compression labels do not have proper QC -->  we are using workaround with sct_label_utils
+    'FILES_COMPRESSION': 'sct_label_utils',
+    'FILES_PMJ': 'sct_detect_pmj',
+    # Note: sct_get_centerline does not have proper QC -->  we are using workaround with sct_label_vertebrae
+    # Details: https://github.com/spinalcordtoolbox/spinalcordtoolbox/issues/4011#issuecomment-1403828459
+    'FILES_CENTERLINE': 'sct_label_vertebrae',
+    'FILES_LESION': 'sct_deepseg_lesion',
+}
+
+# Tasks for which the QC is skipped if the label file is empty (not all sct_qc -p functions support empty label files)
+# Context: https://github.com/spinalcordtoolbox/manual-correction/issues/60#issuecomment-1720280352
+TASKS_SKIP_QC_IF_EMPTY = frozenset({'FILES_LABEL', 'FILES_COMPRESSION', 'FILES_PMJ', 'FILES_CENTERLINE'})
+
+# Answers accepted when asking whether to modify an already existing file: answer -> (do_labeling, do_labeling_always)
+ANSWERS_MODIFY = {
+    'y': (True, False),
+    'n': (False, False),
+    'Y': (True, True),
+}
+
+# Custom Python script opening a second orthoview in FSLeyes (see create_fsleyes_script)
+FSLEYES_SCRIPT = dedent(
+    """\
+    ortho_left = frame.addViewPanel(OrthoPanel)
+    ortho_right = frame.addViewPanel(OrthoPanel)
+    ortho_left.defaultLayout()
+    ortho_right.defaultLayout()
+    """)
+
+# Commands used to launch each viewer (the first command found in PATH is used)
+VIEWER_COMMANDS = {
+    'fsleyes': ['fsleyes'],
+    'itksnap': ['itksnap',      # macOS and Linux
+                'ITK-SNAP'],    # Windows
+    'slicer': ['slicer'],
+}
+
+
+def check_label_list(label_list):
+    """
+    Check the format of the '-label-disc-list' flag, so that a wrong value is reported when parsing the arguments and
+    not when the first disc labeling viewer is opened.
+    Note: the list is passed as it is to 'sct_label_utils -create-viewer', which expands it.
+    :param label_list: str: comma-separated list containing individual values and/or intervals. Example: '1:4,6,8'
+    :return: str: input label list
+    """
+    if not re.fullmatch(r'\d+(:\d+)?(,\d+(:\d+)?)*', label_list):
+        raise argparse.ArgumentTypeError(f"invalid list of labels: '{label_list}'. Example of valid list: '1:4,6,8'")
+    return label_list
 
 
 def get_parser():
@@ -67,33 +169,7 @@ def get_parser():
         "\nNote: if you want to iterate over all subjects, you can use the wildcard '*' (Examples: sub-*_T1w.nii.gz, "
         "sub-*_ses-M0_T2w.nii.gz, sub-*_ses-M0_T2w_RPI_r.nii.gz, etc.).\n"
         "Below is an example YAML file:\n"
-        + dedent(
-            """
-            FILES_SEG:
-            - sub-001_T1w.nii.gz
-            - sub-002_T2w.nii.gz
-            FILES_GMSEG:
-            - sub-001_T1w.nii.gz
-            - sub-002_T2w.nii.gz
-            FILES_LESION:
-            - sub-001_T1w.nii.gz
-            - sub-002_T2w.nii.gz
-            FILES_LABEL:
-            - sub-001_T1w.nii.gz
-            - sub-002_T1w.nii.gz
-            FILES_COMPRESSION:
-            - sub-001_T1w.nii.gz
-            - sub-002_T1w.nii.gz
-            FILES_PMJ:
-            - sub-001_T1w.nii.gz
-            - sub-002_T1w.nii.gz
-            FILES_ROOTLETS:
-            - sub-001_T1w.nii.gz
-            - sub-002_T1w.nii.gz
-            FILES_CENTERLINE:
-            - sub-001_T1w.nii.gz
-            - sub-002_T1w.nii.gz\n
-            """)
+        + YAML_EXAMPLE
     )
     parser.add_argument(
         '-path-img',
@@ -176,6 +252,7 @@ def get_parser():
         '-label-disc-list',
         help="Comma-separated list containing individual values and/or intervals for disc labeling. Example: '1:4,6,8' "
              "or 1:25 (default)",
+        type=check_label_list,
         default='1:25'
     )
     parser.add_argument(
@@ -238,6 +315,12 @@ def get_parser():
              "Skip the copy of the source files, and the opening of the manual correction pop-up windows.",
         action='store_true'
     )
+    parser.add_argument(
+        '-force-qc',
+        help="Generate the QC reports even if they are up to date (i.e., if the image and the label did not change since "
+             "the QC report was generated).",
+        action='store_true'
+    )
     parser.add_argument(
         '-qc-lesion-plane',
         help="Plane of the lesion QC. Available options: sagittal (default), axial.",
@@ -260,22 +343,15 @@ def get_parser():
              "automatically created by SCT 6.4+). If so, the script will reuse its metadata. In such cases, you do not "
              "need to use this flag.\n"
              "Below is an example JSON file:\n"
-             + dedent(
-             """
-             {
-                "Name": "sct_deepseg_sc",
-                "Version": "SCT v6.2",
-                "Date": "yyyy-mm-dd hh:mm:ss"
-             }\n
-             """),
+             + JSON_EXAMPLE,
     )
     parser.add_argument(
         '-change-orient',
         type=str,
         help=
-        "R|Orientation to show the image in the viewer. If provided, the image and label will be reoriented before "
-        "opening the viewer. After manual correction, the image and label will be reoriented back to the original "
-        "orientation.\n"
+        "R|Orientation to show the image in the viewer. If provided, a reoriented copy of the image (in a temporary "
+        "folder) and the label will be opened in the viewer. After manual correction, the label will be reoriented "
+        "back to the original orientation. The input image is not modified.\n"
         "Warning: be aware of this issue when using this flag: "
         "https://github.com/spinalcordtoolbox/manual-correction/issues/101",
         choices=['LAS', 'LAI', 'LPS', 'LPI', 'LSA', 'LSP', 'LIA', 'LIP', 'RAS', 'RAI', 'RPS', 'RPI', 'RSA', 'RSP',
@@ -284,6 +360,24 @@ def get_parser():
                  'IRA', 'IRP', 'IAL', 'IAR', 'IPL', 'IPR'],
         default=''
     )
+    parser.add_argument(
+        '-jobs',
+        metavar="<int>",
+        type=utils.positive_int,
+        help="Number of QC reports ('sct_qc' calls) generated in parallel. Use 1 to generate them sequentially "
+             "(default: 4).",
+        default=4
+    )
+    parser.add_argument(
+        '-threads',
+        metavar="<int>",
+        type=utils.positive_int,
+        help="Number of threads used by each SCT subprocess ('sct_qc', 'sct_maths -denoise'), set via the "
+             "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS, OMP_NUM_THREADS, OPENBLAS_NUM_THREADS and MKL_NUM_THREADS "
+             "environment variables. By default, 'sct_qc' is limited to 1 thread when '-jobs' > 1 (to avoid "
+             "oversubscription of the CPU), and the denoising is not limited.",
+        default=None
+    )
     parser.add_argument(
         '-v', '--verbose',
         help="Full verbose (for debugging)",
@@ -308,35 +402,30 @@ class ParamFSLeyes:
         """
         self.cm = cm
         self.dr = dr
+        # Parse the display range only once (it is used for each file)
+        self.dr_min_pct, self.dr_max_pct = (int(value) for value in dr.split(','))
         self.min_dr = min_dr
         self.max_dr = max_dr
         self.a = a
         self.second_orthoview = second_orthoview
 
 
+@functools.lru_cache(maxsize=1)
 def create_fsleyes_script():
     """
     Create a custom Python script to interact with the FSLeyes API.
     Note: the second orthoview cannot be opened from the CLI, instead, FSLeyes API via a custom Python script must
     be used. For details, see: https://www.jiscmail.ac.uk/cgi-bin/wa-jisc.exe?A2=FSL;ab356891.2301
-    :param fname: path of the input image.
-    :param fname_seg_out: path to the derivative label file
-    :param fname_other_contrast: path of the other contrast to be loaded in FSLeyes.
-    :param param_fsleyes:
-    :return:
+    Note: the script does not depend on the input files, so it is created only once per run and then reused. Its
+    temporary folder is removed when the program exits.
+    :return: path to the custom Python script.
     """
-    python_script = [
-        "ortho_left = frame.addViewPanel(OrthoPanel)",
-        "ortho_right = frame.addViewPanel(OrthoPanel)",
-        "ortho_left.defaultLayout()",
-        "ortho_right.defaultLayout()",
-        ""
-    ]
-
     # Create a temporary script
-    fname_script = os.path.join(tempfile.mkdtemp(), 'custom_fsleyes_script.py')
+    path_tmp = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, path_tmp, ignore_errors=True)
+    fname_script = os.path.join(path_tmp, 'custom_fsleyes_script.py')
     with open(fname_script, 'w') as f:
-        f.write('\n'.join(python_script))
+        f.write(FSLEYES_SCRIPT)
 
     return fname_script
 
@@ -347,27 +436,25 @@ def get_function_for_qc(task):
     :param task:
     :return:
     """
-    if task == 'FILES_SEG':
-        return 'sct_deepseg_sc'
-    elif task == "FILES_GMSEG":
-        return "sct_deepseg_gm"
-    elif task == 'FILES_LABEL':
-        return 'sct_label_utils'
-    elif task == 'FILES_COMPRESSION':
-        # Note: compression labels do not have proper QC -->  we are using workaround with sct_label_utils
-        return 'sct_label_utils'
-    elif task == 'FILES_PMJ':
-        return 'sct_detect_pmj'
-    elif task == 'FILES_CENTERLINE':
-        # Note: sct_get_centerline does not have proper QC -->  we are using workaround with sct_label_vertebrae
-        # Details: https://github.com/spinalcordtoolbox/spinalcordtoolbox/issues/4011#issuecomment-1403828459
-        return 'sct_label_vertebrae'
-    elif task == 'FILES_LESION':
-        return 'sct_deepseg_lesion'
-    else:
+    try:
+        return QC_FUNCTIONS[task]
+    except KeyError:
         raise ValueError("This task is not recognized: {}".format(task))
 
 
+def find_viewer(viewer):
+    """
+    Find the command to launch the viewer.
+    :param viewer: viewer name, e.g., 'fsleyes'
+    :return: absolute path to the command launching the viewer, or None if the viewer is not installed
+    """
+    for cmd in VIEWER_COMMANDS[viewer]:
+        path_cmd = utils.which(cmd)
+        if path_cmd is not None:
+            return path_cmd
+    return None
+
+
 def correct_segmentation(fname, fname_seg_out, fname_other_contrast, viewer, param_fsleyes):
     """
     Open viewer (ITK-SNAP, FSLeyes, or 3D Slicer) with fname and fname_seg_out.
@@ -383,28 +470,23 @@ def correct_segmentation(fname, fname_seg_out, fname_other_contrast, viewer, par
     if viewer == 'itksnap':
         print("In ITK-SNAP, correct the segmentation, then save it with the same name (overwrite).")
         # Note: command line differs for macOs/Linux and Windows
-        if shutil.which('itksnap') is not None:  # Check if command 'itksnap' exists
-            # macOS and Linux
-            subprocess.check_call(['itksnap',
-                                   '-g', fname,
-                                   '-s', fname_seg_out])
-            
-        elif shutil.which('ITK-SNAP') is not None:  # Check if command 'ITK-SNAP' exists
-            # Windows
-            subprocess.check_call(['ITK-SNAP',
+        viewer_cmd = find_viewer(viewer)
+        if viewer_cmd is not None:
+            subprocess.check_call([viewer_cmd,
                                    '-g', fname,
                                    '-s', fname_seg_out])
         else:
             viewer_not_found(viewer)
     # launch FSLeyes
     elif viewer == 'fsleyes':
-        if shutil.which('fsleyes') is not None:  # Check if command 'fsleyes' exists
+        viewer_cmd = find_viewer(viewer)
+        if viewer_cmd is not None:  # Check if command 'fsleyes' exists
             # Get min and max intensity
             min_intensity, max_intensity = utils.get_image_intensities(fname)
             # Set min intensity
-            param_fsleyes.min_dr = str((max_intensity * int(param_fsleyes.dr.split(',')[0]))/100)
+            param_fsleyes.min_dr = str((max_intensity * param_fsleyes.dr_min_pct)/100)
             # Decrease max intensity
-            param_fsleyes.max_dr = str((max_intensity * int(param_fsleyes.dr.split(',')[1]))/100)
+            param_fsleyes.max_dr = str((max_intensity * param_fsleyes.dr_max_pct)/100)
 
             print("In FSLeyes, click on 'Edit mode', correct the segmentation, and then save it with the same name "
                   "(overwrite).")
@@ -413,44 +495,22 @@ def correct_segmentation(fname, fname_seg_out, fname_other_contrast, viewer, par
             # -dr, --displayRange   Set display range (min max) for the specified overlay
             # -cm, --cmap           Set colour map for the specified overlay
             # -a, --alpha           Set alpha (opacity) for the specified overlay
+            cmd = [viewer_cmd, '-S']
+            # Open a second orthoview (i.e., open two orthoviews next to each other) using a custom Python script
+            # (-r flag)
+            if param_fsleyes.second_orthoview:
+                cmd += ['-r', create_fsleyes_script()]
+            cmd += [fname, '-dr', param_fsleyes.min_dr, param_fsleyes.max_dr]
+            # Load the other contrast (if specified)
             if fname_other_contrast:
-                # Open a second orthoview (i.e., open two orthoviews next to each other) using a custom Python script
-                # (-r flag)
-                if param_fsleyes.second_orthoview:
-                    fname_script = create_fsleyes_script()
-                    subprocess.check_call(['fsleyes',
-                                           '-S',
-                                           '-r', fname_script,
-                                           fname, '-dr', param_fsleyes.min_dr, param_fsleyes.max_dr,
-                                           fname_other_contrast,
-                                           fname_seg_out, '-cm', param_fsleyes.cm, '-a', param_fsleyes.a])
-                # No second orthoview
-                else:
-                    subprocess.check_call(['fsleyes',
-                                           '-S',
-                                           fname, '-dr', param_fsleyes.min_dr, param_fsleyes.max_dr,
-                                           fname_other_contrast,
-                                           fname_seg_out, '-cm', param_fsleyes.cm, '-a', param_fsleyes.a])
-            # Open a second orthoview without second contrast
-            elif param_fsleyes.second_orthoview:
-                fname_script = create_fsleyes_script()
-                subprocess.check_call(['fsleyes',
-                                       '-S',
-                                       '-r', fname_script,
-                                       fname, '-dr', param_fsleyes.min_dr, param_fsleyes.max_dr,
-                                       fname_seg_out, '-cm', param_fsleyes.cm, '-a', param_fsleyes.a])
-            # No second contrast, no second orthoview
-            else:
-                subprocess.check_call(['fsleyes',
-                                       '-S',
-                                       fname,
-                                       '-dr', param_fsleyes.min_dr, param_fsleyes.max_dr,
-                                       fname_seg_out, '-cm', param_fsleyes.cm, '-a', param_fsleyes.a])
+                cmd.append(fname_other_contrast)
+            cmd += [fname_seg_out, '-cm', param_fsleyes.cm, '-a', param_fsleyes.a]
+            subprocess.check_call(cmd)
         else:
             viewer_not_found(viewer)
     # launch 3D Slicer
     elif viewer == 'slicer':
-        if shutil.which('slicer') is not None:
+        if find_viewer(viewer) is not None:
             # TODO: Add instructions for 3D Slicer
             pass
         else:
@@ -475,17 +535,18 @@ def correct_vertebral_labeling(fname, fname_label, label_list, viewer='sct_label
     :param label_list: Comma-separated list containing individual values and/or intervals. Example: '1:4,6,8' or 1:20
     :return:
     """
-    if shutil.which(viewer) is not None:  # Check if command 'sct_label_utils' exists
+    viewer_cmd = utils.which(viewer)
+    if viewer_cmd is not None:  # Check if command 'sct_label_utils' exists
         message = "Click at the posterior tip of the disc(s). Then click 'Save and Quit'."
         if os.path.exists(fname_label):
-            subprocess.check_call(['sct_label_utils', 
+            subprocess.check_call([viewer_cmd, 
                                    '-i', fname, 
                                    '-create-viewer', label_list, 
                                    '-o', fname_label, 
                                    '-ilabel', fname_label, 
                                    '-msg', message])
         else:
-            subprocess.check_call(['sct_label_utils',
+            subprocess.check_call([viewer_cmd,
                                    '-i', fname,
                                    '-create-viewer', label_list,
                                    '-o', fname_label,
@@ -501,9 +562,10 @@ def correct_pmj_label(fname, fname_label, viewer='sct_label_utils'):
     :param fname_label:
     :return:
     """
-    if shutil.which(viewer) is not None:  # Check if command 'sct_label_utils' exists
+    viewer_cmd = utils.which(viewer)
+    if viewer_cmd is not None:  # Check if command 'sct_label_utils' exists
         message = "Click at the posterior tip of the pontomedullary junction (PMJ). Then click 'Save and Quit'."
-        subprocess.check_call(['sct_label_utils',
+        subprocess.check_call([viewer_cmd,
                                '-i', fname,
                                '-create-viewer', '50',
                                '-o', fname_label,
@@ -516,18 +578,33 @@ def correct_centerline(fname, fname_label, viewer='sct_get_centerline'):
     """
     Open sct_get_centerline viewer to manually label spinal cord centerline.
     """
-    if shutil.which(viewer) is not None:  # Check if command 'sct_get_centerline' exists
+    viewer_cmd = utils.which(viewer)
+    if viewer_cmd is not None:  # Check if command 'sct_get_centerline' exists
         print("Select a few points to extract the centerline. Then click 'Save and Quit'.")
-        subprocess.check_call(['sct_get_centerline',
+        subprocess.check_call([viewer_cmd,
                                '-i', fname,
-                               '-method viewer' 
+                               '-method', 'viewer',
                                '-gap', '30',
-                               '-qc qc-manual',
+                               '-qc', 'qc-manual',
                                '-o', fname_label])
     else:
         viewer_not_found(viewer)
 
 
+def parse_json(fname):
+    """
+    Parse JSON file (with orjson if it is installed).
+    Note: orjson.JSONDecodeError is a subclass of json.JSONDecodeError, so callers only need to catch the latter.
+    :param fname: path to the JSON file.
+    :return: dictionary with the content of the JSON file.
+    """
+    if orjson is not None:
+        with open(fname, "rb") as f:
+            return orjson.loads(f.read())
+    with open(fname, "r") as f:
+        return json.load(f)
+
+
 def load_json(fname):
     """
     Load existing JSON file. The content of the JSON file will be added to the JSON file produced by this script.
@@ -537,9 +614,7 @@ def load_json(fname):
     if not os.path.isfile(fname):
         sys.exit("ERROR: The file {} does not exist.".format(fname))
     try:
-        with open(fname, "r") as f:
-            json_metadata = json.load(f)
-        return json_metadata
+        return parse_json(fname)
     except json.JSONDecodeError:
         sys.exit("ERROR: The file {} is not a valid JSON file.".format(fname))
 
@@ -552,13 +627,14 @@ def update_json(fname_nifti, name_rater, json_metadata):
     :param json_metadata: dict: Dictionary with the metadata to be added to the JSON sidecar
     :return:
     """
-    fname_json = fname_nifti.replace('.gz', '').replace('.nii', '.json')
+    # Note: utils.splitext is used to replace only the extension (.nii or .nii.gz), not a '.nii' or '.gz' substring
+    # elsewhere in the path
+    fname_json = utils.splitext(fname_nifti)[0] + '.json'
 
     # Check if the json file already exists, if so, open it
     if os.path.exists(fname_json):
         # Read already existing json file
-        with open(fname_json, "r") as outfile:  # r to read
-            json_dict = json.load(outfile)
+        json_dict = parse_json(fname_json)
 
         # Special checks to fix all of our current json files (Might be deleted later)
         if 'GeneratedBy' not in json_dict.keys():
@@ -577,10 +653,12 @@ def update_json(fname_nifti, name_rater, json_metadata):
             # If json_metadata already contains the 'GeneratedBy' key (for example when the label was generated by SCT),
             # use the existing key. Otherwise, create a new one. This will prevent duplication of the 'GeneratedBy' key.
             # Context: https://github.com/spinalcordtoolbox/manual-correction/issues/108
+            # Note: a deep copy is used because json_metadata is shared across files (the 'GeneratedBy' list would be
+            # modified below)
             if 'GeneratedBy' in json_metadata.keys():
-                json_dict.update(json_metadata)
+                json_dict.update(deepcopy(json_metadata))
             else:
-                json_dict['GeneratedBy'].append(json_metadata.copy())
+                json_dict['GeneratedBy'].append(deepcopy(json_metadata))
 
     # If the label was modified or just checked, add "Name": "Manual" to the JSON sidecar
     json_dict['GeneratedBy'].append({'Name': 'Manual',
@@ -588,13 +666,50 @@ def update_json(fname_nifti, name_rater, json_metadata):
                                      'Date': time.strftime('%Y-%m-%d %H:%M:%S')})
 
     # Write the data to the JSON file
+    # Note: the JSON is serialized in memory and written at once (json.dump would issue one write per JSON token)
     with open(fname_json, 'w') as outfile:  # w to overwrite the file
-        json.dump(json_dict, outfile, indent=4)
         # Add last newline
-        outfile.write("\n")
+        outfile.write(json.dumps(json_dict, indent=4) + "\n")
     print("JSON sidecar was updated: {}".format(fname_json))
 
 
+def reorient_label(fname_label, orientation):
+    """
+    Change the orientation of the label (in place), if different from the desired orientation.
+    :param fname_label: path to the label file
+    :param orientation: desired orientation, e.g., 'RPI'
+    :return: original orientation of the label
+    """
+    label_orig_orient = utils.get_orientation(fname_label)
+    if label_orig_orient != orientation:
+        utils.change_orientation(fname_label, orientation)
+    return label_orig_orient
+
+
+def get_fname_in(path_img, file):
+    """
+    Get the path of the input image.
+    :param path_img: input folder, example: <PATH_DATA>/data_processed
+    :param file: input file from the YAML file, example: sub-001_T2w.nii.gz
+    :return: input image, example: <PATH_DATA>/data_processed/sub-001/anat/sub-001_T2w.nii.gz
+    """
+    subject, ses, filename, contrast = utils.fetch_subject_and_session(file)
+    return os.path.join(path_img, subject, ses, contrast, filename)
+
+
+def get_fname_label(path_label, file, suffix):
+    """
+    Get the path of a label file, i.e., the input label or the output file (path where manually corrected file will be
+    saved), which share the same layout.
+    :param path_label: label folder, example: <PATH_DATA>/derivatives/labels
+    :param file: input file from the YAML file, example: sub-001_T2w.nii.gz
+    :param suffix: suffix of the task, example: _seg
+    :return: label file, example: <PATH_DATA>/derivatives/labels/sub-001/anat/sub-001_T2w_seg.nii.gz
+    """
+    subject, ses, filename, contrast = utils.fetch_subject_and_session(file)
+    return utils.add_suffix(os.path.join(path_label, subject, ses, contrast, filename), suffix)
+
+
 def ask_if_modify(fname_out, fname_label, do_labeling_always=False):
     """
     Check if the output file already exists. If so, asks user if they want to modify it.
@@ -606,21 +721,15 @@ def ask_if_modify(fname_out, fname_label, do_labeling_always=False):
     """
     # Check if the output file already exists
     if os.path.isfile(fname_out):
-        answer = None
         if not do_labeling_always:
             print(f'WARNING! The file {fname_out} already exists.')
-            while answer not in ("y", "n", "Y"):
+            while True:
                 answer = input(f'Would you like to modify it? (type "y" to modify, type "n" to skip, type "Y" to '
                                f'modify all files): ')
-                if answer == "y":
-                    do_labeling = True
-                elif answer == "n":
-                    do_labeling = False
-                elif answer == "Y":
-                    do_labeling_always = True
-                    do_labeling = True
-                else:
-                    print("Invalid input. Please enter [y/n/Y].")
+                if answer in ANSWERS_MODIFY:
+                    do_labeling, do_labeling_always = ANSWERS_MODIFY[answer]
+                    break
+                print("Invalid input. Please enter [y/n/Y].")
         else:
             do_labeling = True
         # We don't want to copy because we want to modify the existing file
@@ -628,7 +737,7 @@ def ask_if_modify(fname_out, fname_label, do_labeling_always=False):
         create_empty_mask = False
 
     # If the output file does not exist, copy it from label folder
-    elif not os.path.isfile(fname_out) and os.path.isfile(fname_label):
+    elif os.path.isfile(fname_label):
         do_labeling = True
         copy = True
         create_empty_mask = False
@@ -641,7 +750,7 @@ def ask_if_modify(fname_out, fname_label, do_labeling_always=False):
     return do_labeling, copy, create_empty_mask, do_labeling_always
 
 
-def generate_qc(fname, fname_label, task, fname_qc, subject, config_file, qc_lesion_plane, suffix_dict):
+def generate_qc(fname, fname_label, task, fname_qc, subject, config_file, qc_lesion_plane, suffix_dict, env=None):
     """
     Generate QC report.
     :param fname: background image
@@ -652,87 +761,159 @@ def generate_qc(fname, fname_label, task, fname_qc, subject, config_file, qc_les
     :param config_file: config file
     :param qc_lesion_plane: plane of the lesion QC
     :param suffix_dict: dictionary of suffixes
-    :return:
+    :param env: environment variables for the SCT subprocesses (default: None, i.e., the current environment)
+    :return: bool: True if the QC report was generated
     """
     # Not all sct_qc -p functions support empty label files. Check if the label file is empty and skip QC if so.
-    # Context: https://github.com/spinalcordtoolbox/manual-correction/issues/60#issuecomment-1720280352
-    skip_qc_list = ['FILES_LABEL', 'FILES_COMPRESSION', 'FILES_PMJ', 'FILES_CENTERLINE']
-    if task in skip_qc_list:
-        img_label = nib.load(fname_label)
-        data_label = img_label.get_fdata()
-        if np.sum(data_label) == 0:
+    if task in TASKS_SKIP_QC_IF_EMPTY:
+        if utils.is_label_empty(fname_label):
             logging.warning(f"File {fname_label} is empty. Skipping QC.\n")
-            return
+            return False
 
     # Lesion QC needs also SC segmentation for cropping
     if task == 'FILES_LESION':
         # Construct SC segmentation file name
-        fname_seg = fname_label.replace(suffix_dict['FILES_LESION'], suffix_dict['FILES_SEG'])
+        fname_seg = get_fname_seg_for_lesion(fname_label, suffix_dict)
         # Check if SC segmentation file exists
         if os.path.isfile(fname_seg):
             print("SC segmentation file found: {}. Creating QC.".format(fname_seg))
             # Lesion QC supports only binary segmentation --> binarize the lesion
             fname_label_bin = utils.add_suffix(fname_label, '_bin')
-            subprocess.check_call(['sct_maths',
-                                   '-i', fname_label,
-                                   '-bin', '0',
-                                   '-o', fname_label_bin])
+            utils.binarize_label(fname_label, fname_label_bin, threshold=0)
             # fname - background image; fname_seg - SC segmentation - used for cropping; fname_label - lesion
             # segmentation
-            subprocess.check_call(['sct_qc',
-                                   '-i', fname,
-                                   '-s', fname_seg,
-                                   '-d', fname_label_bin,
-                                   '-p', get_function_for_qc(task),
-                                   '-plane', qc_lesion_plane,
-                                   '-qc', fname_qc,
-                                   '-qc-subject', subject])
+            utils.run_command(['sct_qc',
+                               '-i', fname,
+                               '-s', fname_seg,
+                               '-d', fname_label_bin,
+                               '-p', get_function_for_qc(task),
+                               '-plane', qc_lesion_plane,
+                               '-qc', fname_qc,
+                               '-qc-subject', subject],
+                              env=env)
             # remove binarized lesion segmentation
             os.remove(fname_label_bin)
-            # Archive QC folder
-            archive_qc(fname_qc, config_file)
+            return True
         else:
             print("WARNING: SC segmentation file not found: {}. QC report will not be generated.".format(fname_seg))
+            return False
 
     # Skip QC for the spinal rootlets segmentation as `sct_qc` does not support it
     # Context: https://github.com/spinalcordtoolbox/spinalcordtoolbox/issues/4166#issuecomment-1654175610
     elif task == 'FILES_ROOTLETS':
-        pass
+        return False
 
     else:
-        subprocess.check_call(['sct_qc',
-                               '-i', fname,
-                               '-s', fname_label,
-                               '-p', get_function_for_qc(task),
-                               '-qc', fname_qc,
-                               '-qc-subject', subject])
-        # Archive QC folder
-        archive_qc(fname_qc, config_file)
+        utils.run_command(['sct_qc',
+                           '-i', fname,
+                           '-s', fname_label,
+                           '-p', get_function_for_qc(task),
+                           '-qc', fname_qc,
+                           '-qc-subject', subject],
+                          env=env)
+        return True
+
+
+def get_fname_seg_for_lesion(fname_label, suffix_dict):
+    """
+    Get the SC segmentation used to crop the lesion QC.
+    :param fname_label: lesion segmentation, example: <PATH_DATA>/derivatives/labels/sub-001/anat/sub-001_T2w_lesion.nii.gz
+    :param suffix_dict: dictionary of suffixes
+    :return: SC segmentation, example: <PATH_DATA>/derivatives/labels/sub-001/anat/sub-001_T2w_seg.nii.gz
+    """
+    # Note: the suffix is replaced only in the file name (not in the folder names)
+    path_folder, filename_label = os.path.split(fname_label)
+    return os.path.join(path_folder, filename_label.replace(suffix_dict['FILES_LESION'], suffix_dict['FILES_SEG']))
+
+
+def get_qc_signature(fname, fname_label, task, qc_lesion_plane, suffix_dict):
+    """
+    Get the signature of a QC report, i.e., the task and the modification times of the image and the label (and for
+    the lesion QC, also the plane and the modification time of the SC segmentation used for cropping). The QC report
+    is up to date if it was generated with the same signature.
+    :param fname: background image
+    :param fname_label: segmentation mask to be overlaid on the background image
+    :param task: task name
+    :param qc_lesion_plane: plane of the lesion QC
+    :param suffix_dict: dictionary of suffixes
+    :return: list: signature of the QC report, or None if one of the input files does not exist
+    """
+    try:
+        signature = [task, os.stat(fname).st_mtime_ns, os.stat(fname_label).st_mtime_ns]
+        if task == 'FILES_LESION':
+            fname_seg = get_fname_seg_for_lesion(fname_label, suffix_dict)
+            signature += [qc_lesion_plane, os.stat(fname_seg).st_mtime_ns]
+        return signature
+    except FileNotFoundError:
+        return None
+
+
+def get_qc_report_folder(fname, fname_qc, subject, task):
+    """
+    Get the folder of the QC reports of a file. SCT stores the QC reports in
+    <fname_qc>/<dataset>/<subject>/<contrast>/<function>/, where the dataset and the contrast are the parent folders of
+    the image (e.g., <PATH_DATA>/data_processed/sub-001/anat/sub-001_T2w.nii.gz --> dataset 'data_processed' (or the
+    subject folder if a session folder is present), contrast 'anat').
+    :param fname: background image
+    :param fname_qc: QC folder name
+    :param subject: subject name (passed to sct_qc -qc-subject)
+    :param task: task name
+    :return: folder of the QC reports
+    """
+    path_contrast = os.path.dirname(fname)
+    dataset = os.path.basename(os.path.dirname(os.path.dirname(path_contrast)))
+    return os.path.join(fname_qc, dataset, subject, os.path.basename(path_contrast), get_function_for_qc(task))
+
+
+def is_qc_report_present(path_report):
+    """
+    Check if the QC report still exists (it could have been deleted by the user since it was generated).
+    :param path_report: folder of the QC reports (see get_qc_report_folder)
+    :return: bool: True if the folder exists and is not empty
+    """
+    return os.path.isdir(path_report) and bool(os.listdir(path_report))
 
 
 def archive_qc(fname_qc, config_file):
     """
     Archive QC folder
+    Note: this is done only once, after all QC reports have been generated, because the whole QC folder is zipped.
+    Note: the config file is written directly to the archive (it is not copied to the QC folder first).
     """
-    shutil.copy(utils.get_full_path(config_file), fname_qc)
-    shutil.make_archive(fname_qc, 'zip', fname_qc)
+    utils.zip_folder(fname_qc, fname_qc + '.zip', fnames_extra=[utils.get_full_path(config_file)])
     print("Archive created:\n--> {}".format(fname_qc + '.zip'))
 
 
-def denoise_image(fname):
+def denoise_image(fname, env=None):
     """
     Denoise image using non-local means adaptative denoising from P. Coupe et al. as implemented in dipy. For details,
     run sct_maths -h
+    Note: the denoising runs in the background, call wait_denoise_image before using the denoised image.
     :param fname:
-    :return:
+    :param env: environment variables for the SCT subprocess (default: None, i.e., the current environment)
+    :return: fname_denoised: path to the denoised image
+    :return: process: denoising process
     """
     print("Denoising {}".format(fname))
     fname_denoised = utils.add_suffix(fname, '_denoised-p1b2')
-    subprocess.check_call(['sct_maths',
-                           '-i', fname,
-                           '-denoise', 'p=1,b=2',
-                           '-o', fname_denoised])
-    return fname_denoised
+    # Note: the standard output is discarded, because the denoising runs in the background
+    process = subprocess.Popen(['sct_maths',
+                                '-i', fname,
+                                '-denoise', 'p=1,b=2',
+                                '-o', fname_denoised],
+                               stdout=subprocess.DEVNULL,
+                               env=env)
+    return fname_denoised, process
+
+
+def wait_denoise_image(process):
+    """
+    Wait for the denoising started by denoise_image to finish.
+    :param process: denoising process
+    :return:
+    """
+    if process.wait() != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
 
 
 def remove_denoised_file(fname):
@@ -797,6 +978,21 @@ def main():
     # Check for missing files before starting the whole process
     if not args.add_seg_only:
         utils.check_files_exist(dict_yml, path_img, path_label, suffix_dict)
+        # SCT is required for QC and for the SCT-based viewers; check it once here instead of failing after the first
+        # corrected file
+        if not utils.check_software_installed():
+            sys.exit("ERROR: SCT is required. Please install it or check if it was added to PATH variable.")
+        # Check that the viewers are installed before starting the manual corrections (instead of failing after the
+        # first file)
+        if not args.qc_only:
+            viewers = set()
+            if any(task in dict_yml for task in ['FILES_SEG', 'FILES_GMSEG', 'FILES_ROOTLETS', 'FILES_LESION']):
+                viewers.add(args.viewer)
+            if 'FILES_COMPRESSION' in dict_yml:
+                viewers.add('fsleyes')
+            for viewer in sorted(viewers):
+                if find_viewer(viewer) is None:
+                    viewer_not_found(viewer)
 
     # Fetch parameters for FSLeyes
     param_fsleyes = ParamFSLeyes(cm=args.fsleyes_cm, dr=args.fsleyes_dr, a=args.fsleyes_a,
@@ -804,12 +1000,15 @@ def main():
 
     # Get list of segmentations files for all subjects in -path-label (if -add-seg-only)
     if args.add_seg_only:
-        path_list = glob.glob(args.path_label + "/**/*" + args.suffix_files_seg + ".nii.gz", recursive=True)
+        if not os.path.isdir(path_label):
+            sys.exit("ERROR: No segmentation file found in {}.".format(path_label))
+        # Note: only the BIDS layout (sub-*/[ses-*/]<datatype>/) is walked
+        path_list = utils.find_bids_files(path_label, args.suffix_files_seg + ".nii.gz")
         # Get only filenames without suffix _seg  to match files in -config .yml list
-        file_list = [utils.remove_suffix(os.path.split(path)[-1], args.suffix_files_seg) for path in path_list]
+        file_list = {utils.remove_suffix(os.path.basename(path), args.suffix_files_seg) for path in path_list}
         # Check if file_list is empty
         if not file_list:
-            sys.exit("ERROR: No segmentation file found in {}.".format(args.path_label))
+            sys.exit("ERROR: No segmentation file found in {}.".format(path_label))
 
     # If a custom JSON file containing metadata was provided, load it, and verify that it is a valid JSON file
     json_metadata = load_json(args.json_metadata) if args.json_metadata else None
@@ -826,8 +1025,19 @@ def main():
     # Set overwrite variable to False
     do_labeling_always = False
 
+    # Output folders already created
+    folders_out = set()
+    # Content of the label folders (listed once per folder, the label folders are not modified by this script)
+    folders_label_content = {}
+
     # TODO: address "none" issue if no file present under a key
-    # Perform manual corrections
+    # Build the list of files to correct for all tasks (wildcards are resolved here), so that the manual corrections are
+    # performed in a single loop over (task, file, fname, fname_label, fname_out) tuples
+    # Note: the paths are built only once here, they are then reused by the check of the existing output files, the
+    # look-ahead denoising and the per-file loop
+    work_list = []
+    # Images found in -path-img; the dataset is walked only once, even if several tasks use a wildcard
+    fnames_img = None
     for task, files in dict_yml.items():
         if task.startswith('FILES'):
             # Check if task is in suffix_dict.keys(), if not, skip it
@@ -841,154 +1051,332 @@ def main():
             # TODO: probably extend also for other tasks (such as FILES_GMSEG)
             if args.add_seg_only and task == 'FILES_SEG':
                 # Remove the files in the -config list
-                for file in files:
-                    # Remove the file suffix (e.g., '_RPI_r') to match the list of files in -path-img
-                    file = utils.remove_suffix(file, args.suffix_files_in)
-                    if file in file_list:
-                        file_list.remove(file)
-                files = file_list  # Rename to use those files instead of the ones to exclude
+                # Note: the file suffix (e.g., '_RPI_r') is removed to match the list of files in -path-img
+                files_to_exclude = {utils.remove_suffix(file, args.suffix_files_in) for file in files}
+                files = sorted(file_list - files_to_exclude)  # Use those files instead of the ones to exclude
             if len(files) > 0:
                 # Handle regex (i.e., iterate over all subjects)
                 if '*' in files[0] and len(files) == 1:
                     subject, ses, filename, contrast = utils.fetch_subject_and_session(files[0])
-                    # Get list of files recursively
-                    glob_files = sorted(glob.glob(os.path.join(path_img, '**', filename),
-                                            recursive=True))
+                    # Get list of files matching the wildcard
+                    # Note: only the BIDS layout (sub-*/[ses-*/]<datatype>/) is walked, so the labels under
+                    # derivatives are never listed
+                    if fnames_img is None:
+                        fnames_img = list(utils.find_bids_files(path_img, '.nii.gz'))
+                    glob_files = [file for file in fnames_img
+                                  if fnmatch.fnmatchcase(os.path.basename(file), filename)]
                     # Skip filenames containing "notused"
                     glob_files = [file for file in glob_files if 'notused' not in file]
                     # Get list of already corrected files
+                    # Note: a set is used for O(1) membership test below
                     if task.replace('FILES', 'CORR') in dict_yml.keys():
-                        corr_files = dict_yml[task.replace('FILES', 'CORR')]
+                        corr_files = set(dict_yml[task.replace('FILES', 'CORR')])
                     else:
-                        corr_files = []
-                    #  Remove labels under derivatives and already corrected files
-                    files = []
-                    for file in glob_files:
-                        subject, ses, filename, contrast = utils.fetch_subject_and_session(file)
-                        if ('derivatives' not in file) and (filename not in corr_files):
-                            files.append(file)
-                # Loop across files
-                for file in tqdm.tqdm(files, desc="{}".format(task), unit="file"):
-                    # Print empty line to not overlay with tqdm progress bar
-                    time.sleep(0.1)
-                    print("")
-                    # build file names
-                    subject, ses, filename, contrast = utils.fetch_subject_and_session(file)
-                    # Construct absolute path to the input file
+                        corr_files = set()
+                    #  Remove already corrected files
+                    # Note: only the file name is needed here, the path is parsed once later in the per-file loop
+                    files = [file for file in glob_files if os.path.basename(file) not in corr_files]
+                suffix = suffix_dict[task]
+                for file in files:
+                    # Absolute path to the input file
                     # For example: '/Users/user/dataset/data_processed/sub-001/anat/sub-001_T2w.nii.gz'
-                    fname = os.path.join(path_img, subject, ses, contrast, filename)
-                    # Construct absolute path to the other contrast file
-                    if args.load_other_contrast:
-                        # Do not include session in the filename
-                        if ses == '':
-                            other_contrast_filename = subject + '_' + args.load_other_contrast + '.nii.gz'
-                        # Include session in the filename
-                        else:
-                            other_contrast_filename = subject + '_' + ses + '_' + args.load_other_contrast + '.nii.gz'
-                        fname_other_contrast = os.path.join(path_img, subject, ses, contrast, other_contrast_filename)
-                    else:
-                        fname_other_contrast = None
-                    # Construct absolute path to the input label (segmentation, labeling etc.) file
+                    fname = get_fname_in(path_img, file)
+                    # Absolute path to the input label (segmentation, labeling etc.) file
                     # For example: '/Users/user/dataset/data_processed/sub-001/anat/sub-001_T2w_seg.nii.gz'
-                    fname_label = utils.add_suffix(os.path.join(path_label, subject, ses, contrast, filename), suffix_dict[task])
-                    
-                    # Construct absolute path to the output file (i.e., path where manually corrected file will be saved)
+                    fname_label = get_fname_label(path_label, file, suffix)
+                    # Absolute path to the output file (i.e., path where manually corrected file will be saved)
                     # For example: '/Users/user/dataset/derivatives/labels/sub-001/anat/sub-001_T2w_seg.nii.gz'
                     # The information regarding the modified data will be stored within the sidecar .json file
-                    fname_out = utils.add_suffix(os.path.join(path_out, subject, ses, contrast, filename), suffix_dict[task])
-
-                    # Change orientation of the input image (if different from the original orientation)
-                    if args.change_orient:
-                        # Get image and label orientation
-                        image_orig_orient = utils.get_orientation(fname)
-                        label_orig_orient = utils.get_orientation(fname_label)
-                        # Change orientation of the input image for better visualization
-                        if image_orig_orient != args.change_orient or label_orig_orient != args.change_orient:
-                            utils.change_orientation(fname, args.change_orient)
-                            utils.change_orientation(fname_label, args.change_orient)
-                    
-                    # Create subject folder in output if they do not exist
-                    os.makedirs(os.path.join(path_out, subject, ses, contrast), exist_ok=True)
-                    if not args.qc_only:
-                        # Check if the output file already exists. If so, asks user if they want to modify it.
-                        do_labeling, copy, create_empty_mask, do_labeling_always = \
-                            ask_if_modify(fname_out=fname_out,
-                                        fname_label=fname_label,
-                                        do_labeling_always=do_labeling_always)
-                        # Perform labeling (i.e., segmentation correction, labeling correction etc.) for the specific task
-                        if do_labeling:
-                            if args.denoise:
-                                # Denoise the input file
-                                fname = denoise_image(fname)
-                            # Copy file to derivatives folder
-                            if copy:
-                                shutil.copyfile(fname_label, fname_out)
-                                print(f'Copying: {fname_label} to {fname_out}')
-                                # If the label has a JSON sidecar, read its content
-                                # Context: SCT v6.4+ produces JSON sidecars for some outputs that track the provenance
-                                # of the function, models, etc.
-                                # Details: https://github.com/spinalcordtoolbox/spinalcordtoolbox/pull/4466
-                                # We want to include this information in the final JSON sidecar
-                                fname_label_json = fname_label.replace('.nii.gz', '.json')
-                                if os.path.isfile(fname_label_json):
-                                    # Read the JSON file to include the metadata in the final JSON sidecar
-                                    json_metadata = load_json(fname_label_json)
-                            # Create empty mask in derivatives folder
-                            elif create_empty_mask:
-                                utils.create_empty_mask(fname, fname_out)
-
-                            if task in ['FILES_SEG', 'FILES_GMSEG', 'FILES_ROOTLETS']:
-                                if not args.add_seg_only:
-                                    correct_segmentation(fname, fname_out, fname_other_contrast, args.viewer, param_fsleyes)
-                            elif task == 'FILES_LESION':
-                                correct_segmentation(fname, fname_out, fname_other_contrast, args.viewer, param_fsleyes)
-                            elif task == 'FILES_LABEL':
-                                correct_vertebral_labeling(fname, fname_out, args.label_disc_list)
-                            elif task == 'FILES_COMPRESSION':
-                                # Note: be aware of possibility to create compression labels also using
-                                # 'sct_label_utils -create-viewer'
-                                # Context: https://github.com/spinalcordtoolbox/spinalcordtoolbox/issues/3984
-                                correct_segmentation(fname, fname_out, fname_other_contrast, 'fsleyes', param_fsleyes)
-                            elif task == 'FILES_PMJ':
-                                correct_pmj_label(fname, fname_out)
-                            elif task == 'FILES_CENTERLINE':
-                                correct_centerline(fname, fname_out)
-                            else:
-                                sys.exit('Task not recognized from the YAML file: {}'.format(task))
-                            if args.denoise:
-                                # Remove the denoised file (we do not need it anymore)
-                                remove_denoised_file(fname)
-
-                            # Add segmentation only (skip generating QC report)
-                            if args.add_seg_only:
-                                # We use update_json because we are adding a new segmentation, and we want to create
-                                # a JSON file
-                                update_json(fname_out, name_rater, json_metadata)
-                            # Generate QC report
-                            else:
-                                update_json(fname_out, name_rater, json_metadata)
-                                # Generate QC report
-                                generate_qc(fname, fname_out, task, fname_qc, subject, args.config, args.qc_lesion_plane, suffix_dict)
-
-                    # Generate QC report only
-                    if args.qc_only:
-                        generate_qc(fname, fname_out, task, fname_qc, subject, args.config, args.qc_lesion_plane, suffix_dict)
-                    
-                    # Keep track of corrected files in YAML.
-                    dict_yml = utils.track_corrections(files_dict=dict_yml.copy(), config_path=args.config, file_path=fname, task=task)
-
-                    # Change orientation of the input image back to the original orientation
-                    if args.change_orient:
-                        image_current_orientation = utils.get_orientation(fname)
-                        label_current_orientation = utils.get_orientation(fname_label)
-                        if image_current_orientation != image_orig_orient or label_current_orientation != label_orig_orient:
-                            utils.change_orientation(fname, image_orig_orient)
-                            utils.change_orientation(fname_out, label_orig_orient)
-
+                    fname_out = get_fname_label(path_out, file, suffix)
+                    work_list.append((task, file, fname, fname_label, fname_out))
             else:
                 sys.exit("ERROR: The list of files to correct is empty. \nMaybe, you have already corrected all the "
                          "files? Please, check the YAML file: {}".format(args.config))
 
+    # If several output files already exist, ask once whether all of them should be modified (instead of asking for
+    # each file during the manual corrections)
+    if not args.qc_only:
+        fnames_out_existing = [fname_out for _, _, _, _, fname_out in work_list if os.path.isfile(fname_out)]
+        if len(fnames_out_existing) > 1:
+            print(f'WARNING! {len(fnames_out_existing)} of the {len(work_list)} output files already exist in '
+                  f'{path_out}.')
+            answer = None
+            while answer not in ("n", "Y"):
+                answer = input('Would you like to modify all of them? (type "Y" to modify all files, type "n" to be '
+                               'asked for each file): ')
+                if answer == "Y":
+                    do_labeling_always = True
+                elif answer != "n":
+                    print("Invalid input. Please enter [n/Y].")
+
+    # QC reports are generated in the background (sct_qc calls are independent), so that the next file can be
+    # processed in the meantime. The QC folder is archived only once at the end.
+    # Note: sct_qc runs in its own process, so threads are sufficient to run several QC in parallel. When running in
+    # parallel, each sct_qc is limited to a single thread to avoid oversubscription of the CPU.
+    qc_executor = ThreadPoolExecutor(max_workers=args.jobs)
+    qc_futures = []
+    # Note: the number of threads set by '-threads' takes precedence over the environment variables set by the user
+    if args.threads is not None:
+        qc_env = utils.get_env_threads(args.threads, override=True)
+    else:
+        qc_env = utils.get_env_threads(1) if args.jobs > 1 else None
+    denoise_env = utils.get_env_threads(args.threads, override=True) if args.threads is not None else None
+
+    # Signatures of the QC reports already generated (see get_qc_signature), so that the QC reports that are up to date
+    # are not generated again: {fname_label: signature}
+    fname_qc_cache = os.path.join(fname_qc, '.qc_cache.json')
+    qc_cache = {}
+    if os.path.isfile(fname_qc_cache):
+        try:
+            qc_cache = parse_json(fname_qc_cache)
+        except ValueError:
+            logging.warning(f"WARNING: {fname_qc_cache} is not a valid JSON file. All QC reports will be generated.")
+
+    def submit_qc(fname, fname_out, task, subject):
+        """
+        Generate QC report in the background (unless it is up to date).
+        :return: future of the QC report, or None if the QC report is up to date
+        Note: with -change-orient, the QC cache is not used: the image is a freshly reoriented temporary copy and the
+        label is reoriented back after the QC, so their modification times always differ from the previous run.
+        """
+        if args.change_orient:
+            signature = None
+        else:
+            signature = get_qc_signature(fname, fname_out, task, args.qc_lesion_plane, suffix_dict)
+        # The QC report is up to date if it was generated with the same signature and if it still exists
+        if not args.force_qc and signature is not None and qc_cache.get(fname_out) == signature and \
+                is_qc_report_present(get_qc_report_folder(fname, fname_qc, subject, task)):
+            logging.info(f"QC report of {fname_out} is up to date. Skipping QC (use -force-qc to generate it).")
+            return None
+
+        def _update_qc_cache(future):
+            if signature is not None and future.exception() is None and future.result():
+                qc_cache[fname_out] = signature
+
+        future = qc_executor.submit(generate_qc, fname, fname_out, task, fname_qc, subject, args.config,
+                                    args.qc_lesion_plane, suffix_dict, qc_env)
+        future.add_done_callback(_update_qc_cache)
+        qc_futures.append(future)
+        return future
+
+    # Images denoised ahead of time (-denoise), i.e., the image of the next file is denoised while the current file is
+    # being corrected: {fname: (fname_denoised, process)}
+    denoise_ahead = {}
+    # Image denoised for the current file, removed in the 'finally' block if the correction is interrupted
+    denoise_current = None
+
+    # Temporary folder for the reoriented images (-change-orient)
+    if args.change_orient:
+        path_tmp_orient = tempfile.mkdtemp()
+
+    tracked_corrections = False
+    # With -qc-only, files whose QC report is being generated are tracked only once their QC has succeeded (so that a
+    # file whose QC failed is not recorded as done and is processed again on the next run): [(future, fname, task)]
+    qc_only_pending = []
+    try:
+        # Perform manual corrections
+        progress_bar = tqdm.tqdm(work_list, unit="file")
+        for i, (task, file, fname, fname_label, fname_out) in enumerate(progress_bar):
+            # Note: set_description refreshes (and flushes) the progress bar, so no delay is needed before printing
+            progress_bar.set_description(task)
+            # Print empty line to not overlay with tqdm progress bar
+            # Note: with -qc-only, nothing is printed for each file (sct_qc runs in the background), so the progress bar
+            # is simply updated in place
+            if not args.qc_only:
+                print("")
+            # build file names
+            # Note: fname, fname_label and fname_out were built with the work list
+            subject, ses, filename, contrast = utils.fetch_subject_and_session(file)
+            # Construct absolute path to the other contrast file
+            if args.load_other_contrast:
+                # Do not include session in the filename
+                if ses == '':
+                    other_contrast_filename = subject + '_' + args.load_other_contrast + '.nii.gz'
+                # Include session in the filename
+                else:
+                    other_contrast_filename = subject + '_' + ses + '_' + args.load_other_contrast + '.nii.gz'
+                fname_other_contrast = os.path.join(os.path.dirname(fname), other_contrast_filename)
+            else:
+                fname_other_contrast = None
+
+            # Change orientation of the input image (if different from the original orientation)
+            # Note: the image is reoriented to a temporary copy (the input image is not modified, so it does not need
+            # to be reoriented back); fname then points to the copy, which is opened in the viewer and used for QC
+            # Note: the copy mirrors the dataset layout (<dataset>/sub-*/[ses-*/]<datatype>/), because sct_qc derives the
+            # dataset and the contrast of the QC report from the parent folders of the image
+            label_orig_orient = None
+            if args.change_orient:
+                image_orig_orient = utils.get_orientation(fname)
+                if image_orig_orient != args.change_orient:
+                    fname_reoriented = get_fname_in(os.path.join(path_tmp_orient, os.path.basename(path_img)), file)
+                    os.makedirs(os.path.dirname(fname_reoriented), exist_ok=True)
+                    utils.change_orientation(fname, args.change_orient, fname_reoriented)
+                    fname = fname_reoriented
+
+            # Create subject folder in output if they do not exist
+            # Note: many files share the same folder, so each folder is created only once
+            path_folder_out = os.path.dirname(fname_out)
+            if path_folder_out not in folders_out:
+                os.makedirs(path_folder_out, exist_ok=True)
+                folders_out.add(path_folder_out)
+            if not args.qc_only:
+                # Check if the output file already exists. If so, asks user if they want to modify it.
+                do_labeling, copy, create_empty_mask, do_labeling_always = \
+                    ask_if_modify(fname_out=fname_out,
+                                fname_label=fname_label,
+                                do_labeling_always=do_labeling_always)
+                # Perform labeling (i.e., segmentation correction, labeling correction etc.) for the specific task
+                if do_labeling:
+                    if args.denoise:
+                        # Denoise the input file (in the background, while the label is copied to the output folder)
+                        if fname in denoise_ahead:
+                            fname_denoised, process_denoise = denoise_ahead.pop(fname)
+                        else:
+                            fname_denoised, process_denoise = denoise_image(fname, denoise_env)
+                        denoise_current = (fname_denoised, process_denoise)
+                        # Denoise the image of the next file while the current file is being corrected
+                        # Note: not possible with -change-orient, because the next image is reoriented only later
+                        if not args.change_orient and i + 1 < len(work_list):
+                            fname_next = work_list[i + 1][2]
+                            if fname_next != fname and fname_next not in denoise_ahead:
+                                denoise_ahead[fname_next] = denoise_image(fname_next, denoise_env)
+                    # Copy file to derivatives folder
+                    if copy:
+                        print(utils.copy_file(fname_label, fname_out))
+                        # If the label has a JSON sidecar, read its content
+                        # Context: SCT v6.4+ produces JSON sidecars for some outputs that track the provenance
+                        # of the function, models, etc.
+                        # Details: https://github.com/spinalcordtoolbox/spinalcordtoolbox/pull/4466
+                        # We want to include this information in the final JSON sidecar
+                        fname_label_json = utils.splitext(fname_label)[0] + '.json'
+                        path_folder_label = os.path.dirname(fname_label)
+                        if path_folder_label not in folders_label_content:
+                            folders_label_content[path_folder_label] = utils.list_files(path_folder_label)
+                        if os.path.basename(fname_label_json) in folders_label_content[path_folder_label]:
+                            # Read the JSON file to include the metadata in the final JSON sidecar
+                            json_metadata = load_json(fname_label_json)
+                    # Create empty mask in derivatives folder
+                    elif create_empty_mask:
+                        utils.create_empty_mask(fname, fname_out)
+                        # The mask is created from the reoriented image, it is reoriented back like the image
+                        if args.change_orient:
+                            label_orig_orient = image_orig_orient
+
+                    # Change orientation of the label for better visualization
+                    if args.change_orient and label_orig_orient is None:
+                        label_orig_orient = reorient_label(fname_out, args.change_orient)
+
+                    # Open the denoised image in the viewer (if -denoise)
+                    if args.denoise:
+                        wait_denoise_image(process_denoise)
+                        fname_viewer = fname_denoised
+                    else:
+                        fname_viewer = fname
+
+                    if task in ['FILES_SEG', 'FILES_GMSEG', 'FILES_ROOTLETS']:
+                        if not args.add_seg_only:
+                            correct_segmentation(fname_viewer, fname_out, fname_other_contrast, args.viewer,
+                                                 param_fsleyes)
+                    elif task == 'FILES_LESION':
+                        correct_segmentation(fname_viewer, fname_out, fname_other_contrast, args.viewer, param_fsleyes)
+                    elif task == 'FILES_LABEL':
+                        correct_vertebral_labeling(fname_viewer, fname_out, args.label_disc_list)
+                    elif task == 'FILES_COMPRESSION':
+                        # Note: be aware of possibility to create compression labels also using
+                        # 'sct_label_utils -create-viewer'
+                        # Context: https://github.com/spinalcordtoolbox/spinalcordtoolbox/issues/3984
+                        correct_segmentation(fname_viewer, fname_out, fname_other_contrast, 'fsleyes', param_fsleyes)
+                    elif task == 'FILES_PMJ':
+                        correct_pmj_label(fname_viewer, fname_out)
+                    elif task == 'FILES_CENTERLINE':
+                        correct_centerline(fname_viewer, fname_out)
+                    else:
+                        sys.exit('Task not recognized from the YAML file: {}'.format(task))
+                    if args.denoise:
+                        # Remove the denoised file (we do not need it anymore)
+                        remove_denoised_file(fname_denoised)
+                        denoise_current = None
+
+                    # Add segmentation only (skip generating QC report)
+                    if args.add_seg_only:
+                        # We use update_json because we are adding a new segmentation, and we want to create
+                        # a JSON file
+                        update_json(fname_out, name_rater, json_metadata)
+                    # Generate QC report
+                    else:
+                        update_json(fname_out, name_rater, json_metadata)
+                        # Generate QC report (in the background)
+                        submit_qc(fname, fname_out, task, subject)
+
+            # Generate QC report only
+            if args.qc_only:
+                if args.change_orient and os.path.isfile(fname_out):
+                    label_orig_orient = reorient_label(fname_out, args.change_orient)
+                future_qc = submit_qc(fname, fname_out, task, subject)
+            else:
+                future_qc = None
+
+            # Keep track of corrected files in YAML.
+            # Note: no copy of dict_yml is needed, track_corrections updates it in place
+            # Note: with -qc-only, the YAML file is written only once at the end (no manual correction can be lost)
+            if future_qc is not None:
+                qc_only_pending.append((future_qc, fname, task))
+            else:
+                dict_yml = utils.track_corrections(files_dict=dict_yml,
+                                                   config_path=None if args.qc_only else args.config,
+                                                   file_path=fname, task=task)
+                tracked_corrections = True
+
+            # Change orientation of the label back to the original orientation
+            if args.change_orient:
+                # The QC report must be generated before the label is reoriented back and the reoriented image removed
+                wait(qc_futures)
+                if label_orig_orient is not None and label_orig_orient != args.change_orient:
+                    utils.change_orientation(fname_out, label_orig_orient)
+                if image_orig_orient != args.change_orient:
+                    os.remove(fname)
+
+    finally:
+        # Remove the temporary folder with the reoriented images
+        if args.change_orient:
+            shutil.rmtree(path_tmp_orient, ignore_errors=True)
+        # Remove the images denoised ahead of time but not used (e.g., the next file was skipped), and the image of the
+        # current file if the correction was interrupted (e.g., viewer error, Ctrl+C)
+        denoise_pending = list(denoise_ahead.values())
+        if denoise_current is not None:
+            denoise_pending.append(denoise_current)
+        for fname_denoised, process_denoise in denoise_pending:
+            # Stop the denoising still running, the image is not needed anymore
+            process_denoise.terminate()
+            process_denoise.wait()
+            if os.path.isfile(fname_denoised):
+                remove_denoised_file(fname_denoised)
+        # Wait until all QC reports are generated
+        qc_executor.shutdown(wait=True)
+        # Track the files whose QC succeeded and write the tracked corrections to the YAML file (with -qc-only, they
+        # are tracked only in memory)
+        if args.qc_only:
+            for future, fname_tracked, task_tracked in qc_only_pending:
+                if future.exception() is None:
+                    dict_yml = utils.track_corrections(files_dict=dict_yml, config_path=None, file_path=fname_tracked,
+                                                       task=task_tracked)
+                    tracked_corrections = True
+            if tracked_corrections:
+                utils.write_yaml_config(dict_yml, args.config)
+        # Archive QC folder (also when the script is stopped, so that the QC of already corrected files is kept)
+        # Note: the archive is also rebuilt if it is missing (e.g., deleted by the user) while all the QC reports are
+        # up to date
+        if any(future.exception() is None and future.result() for future in qc_futures):
+            with open(fname_qc_cache, 'w') as f:
+                f.write(json.dumps(qc_cache, indent=4) + "\n")
+            archive_qc(fname_qc, args.config)
+        elif os.path.isdir(fname_qc) and not os.path.isfile(fname_qc + '.zip'):
+            archive_qc(fname_qc, args.config)
+
+    # Raise errors from QC generation (if any)
+    for future in qc_futures:
+        future.result()
+
 
 if __name__ == '__main__':
     main()
@@ -13,7 +13,7 @@
 #
 
 import os
-import glob
+import fnmatch
 import sys
 import shutil
 import tempfile
@@ -23,6 +23,33 @@ import coloredlogs
 import utils
 
 
+# Example shown in the help of the '-config' flag
+YAML_EXAMPLE = dedent(
+    """
+    FILES_SEG:
+    - sub-001_ses-01_T1w.nii.gz         # example how to specify a specific session
+    - sub-002_T2w.nii.gz
+    FILES_GMSEG:
+    - sub-001_T1w.nii.gz
+    - sub-002_T2w.nii.gz
+    FILES_LESION:
+    - sub-001_T1w.nii.gz
+    - sub-002_T2w.nii.gz
+    FILES_LABEL:
+    - sub-001_T1w.nii.gz
+    - sub-002_T1w.nii.gz
+    FILES_COMPRESSION:
+    - sub-001_T1w.nii.gz
+    - sub-002_T1w.nii.gz
+    FILES_PMJ:
+    - sub-001_T1w.nii.gz
+    - sub-002_T1w.nii.gz
+    FILES_CENTERLINE:
+    - sub-001_T1w.nii.gz
+    - sub-002_T1w.nii.gz\n
+    """)
+
+
 def get_parser():
     """
     parser function
@@ -51,30 +78,7 @@ def get_parser():
         "You can validate your YAML file at this website: http://www.yamllint.com/."
         "Note: if you want to iterate over all subjects, you can use the wildcard '*' (e.g. sub-*_T1w.nii.gz)"
         "Below is an example YAML file:\n"
-        + dedent(
-            """
-            FILES_SEG:
-            - sub-001_ses-01_T1w.nii.gz         # example how to specify a specific session
-            - sub-002_T2w.nii.gz
-            FILES_GMSEG:
-            - sub-001_T1w.nii.gz
-            - sub-002_T2w.nii.gz
-            FILES_LESION:
-            - sub-001_T1w.nii.gz
-            - sub-002_T2w.nii.gz
-            FILES_LABEL:
-            - sub-001_T1w.nii.gz
-            - sub-002_T1w.nii.gz
-            FILES_COMPRESSION:
-            - sub-001_T1w.nii.gz
-            - sub-002_T1w.nii.gz
-            FILES_PMJ:
-            - sub-001_T1w.nii.gz
-            - sub-002_T1w.nii.gz
-            FILES_CENTERLINE:
-            - sub-001_T1w.nii.gz
-            - sub-002_T1w.nii.gz\n
-            """)
+        + YAML_EXAMPLE
     )
     parser.add_argument(
         '-path-in',
@@ -144,9 +148,8 @@ def get_parser():
 def copy_file(fname_in, path_out):
     # create output path
     os.makedirs(path_out, exist_ok=True)
-    # copy file
-    fname_out = shutil.copy(fname_in, path_out)
-    print(f'Copying: {fname_in} to {fname_out}')
+    # copy file (utils.copy_file uses copy_file_range when available and does not copy the permission bits)
+    print(utils.copy_file(fname_in, os.path.join(path_out, os.path.basename(fname_in))))
 
 
 def main():
@@ -192,7 +195,10 @@ def main():
         if '*' in files[0] and len(files) == 1:
             subject, ses, filename, contrast = utils.fetch_subject_and_session(files[0])
             # Get list of files recursively
-            files = sorted(glob.glob(os.path.join(utils.get_full_path(args.path_in), '**', filename), recursive=True))
+            # Note: the folders are listed with os.scandir (see utils.find_files), and the file names are matched
+            # against the wildcard with fnmatch (as glob does)
+            files = [file for file in utils.find_files(utils.get_full_path(args.path_in), suffix='')
+                     if fnmatch.fnmatchcase(os.path.basename(file), filename)]
             # Skip filenames containing "notused"
             files = [file for file in files if 'notused' not in file]
         for file in files:
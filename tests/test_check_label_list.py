@@ -0,0 +1,22 @@
+#######################################################################
+#
+# Tests for check_label_list() function
+#
+# RUN BY:
+#   python -m pytest -v tests/test_check_label_list.py
+#######################################################################
+
+import argparse
+import pytest
+from manual_correction import check_label_list
+
+
+@pytest.mark.parametrize("label_list", ['1:4,6,8', '1:25', '3', '1,2,3', '1:3,5:7'])
+def test_check_label_list_valid(label_list):
+    assert check_label_list(label_list) == label_list
+
+
+@pytest.mark.parametrize("label_list", ['', '1:', 'a', '1,,2', '1:4,', ':4', '1-4'])
+def test_check_label_list_invalid(label_list):
+    with pytest.raises(argparse.ArgumentTypeError):
+        check_label_list(label_list)
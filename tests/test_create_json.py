@@ -134,4 +134,23 @@ def test_update_json_generated_by_sct(tmp_path):
     assert json_file.exists()
     with open(str(json_file), "r") as f:
         metadata = json.load(f)
-    assert metadata == expected_metadata
\ No newline at end of file
+    assert metadata == expected_metadata
+
+
+def test_update_json_metadata_not_modified(tmp_path):
+    """
+    Test that the function update_json() does not modify the custom metadata, which is shared across all corrected
+    files
+    """
+    custom_metadata = {'GeneratedBy': [{'Name': 'spinalcordtoolbox: sct_deepseg', 'Version': '6.5'}]}
+
+    for fname_label in ["sub-001_T1w_seg-manual.nii.gz", "sub-002_T1w_seg-manual.nii.gz"]:
+        nifti_file = tmp_path / fname_label
+        nifti_file.touch()
+        update_json(str(nifti_file), "Test Rater", json_metadata=custom_metadata)
+
+    # Check that the custom metadata were not modified and that the second JSON file contains only one manual entry
+    assert custom_metadata == {'GeneratedBy': [{'Name': 'spinalcordtoolbox: sct_deepseg', 'Version': '6.5'}]}
+    with open(str(tmp_path / "sub-002_T1w_seg-manual.json"), "r") as f:
+        metadata = json.load(f)
+    assert len(metadata['GeneratedBy']) == 2
@@ -0,0 +1,95 @@
+#######################################################################
+#
+# Tests for the QC helpers (get_qc_signature(), get_qc_report_folder(), is_qc_report_present())
+#
+# RUN BY:
+#   python -m pytest -v tests/test_qc.py
+#######################################################################
+
+import os
+
+from manual_correction import get_qc_signature, get_qc_report_folder, is_qc_report_present
+
+SUFFIX_DICT = {'FILES_SEG': '_seg', 'FILES_LESION': '_lesion'}
+
+
+def create_files(path, filenames):
+    """
+    Create empty files with distinct modification times
+    """
+    for i, filename in enumerate(filenames):
+        fname = path / filename
+        fname.touch()
+        os.utime(fname, ns=(1000000000 * (i + 1), 1000000000 * (i + 1)))
+
+
+def test_get_qc_signature(tmp_path):
+    """
+    Test that the signature of the QC report contains the task and the modification times of the image and the label
+    """
+    create_files(tmp_path, ["sub-001_T2w.nii.gz", "sub-001_T2w_seg.nii.gz"])
+    fname = str(tmp_path / "sub-001_T2w.nii.gz")
+    fname_label = str(tmp_path / "sub-001_T2w_seg.nii.gz")
+
+    signature = get_qc_signature(fname, fname_label, 'FILES_SEG', 'sagittal', SUFFIX_DICT)
+    assert signature == ['FILES_SEG', 1000000000, 2000000000]
+
+    # The lesion plane is not part of the signature for other tasks than FILES_LESION
+    assert get_qc_signature(fname, fname_label, 'FILES_SEG', 'axial', SUFFIX_DICT) == signature
+
+    # A modified label changes the signature
+    os.utime(fname_label, ns=(3000000000, 3000000000))
+    assert get_qc_signature(fname, fname_label, 'FILES_SEG', 'sagittal', SUFFIX_DICT) != signature
+
+
+def test_get_qc_signature_lesion(tmp_path):
+    """
+    Test that the signature of the lesion QC report also contains the plane and the SC segmentation used for cropping
+    """
+    create_files(tmp_path, ["sub-001_T2w.nii.gz", "sub-001_T2w_lesion.nii.gz", "sub-001_T2w_seg.nii.gz"])
+    fname = str(tmp_path / "sub-001_T2w.nii.gz")
+    fname_label = str(tmp_path / "sub-001_T2w_lesion.nii.gz")
+
+    signature = get_qc_signature(fname, fname_label, 'FILES_LESION', 'sagittal', SUFFIX_DICT)
+    assert signature == ['FILES_LESION', 1000000000, 2000000000, 'sagittal', 3000000000]
+
+    # Another plane changes the signature
+    assert get_qc_signature(fname, fname_label, 'FILES_LESION', 'axial', SUFFIX_DICT) != signature
+
+    # A corrected SC segmentation changes the signature
+    os.utime(tmp_path / "sub-001_T2w_seg.nii.gz", ns=(4000000000, 4000000000))
+    assert get_qc_signature(fname, fname_label, 'FILES_LESION', 'sagittal', SUFFIX_DICT) != signature
+
+
+def test_get_qc_signature_missing_file(tmp_path):
+    """
+    Test that there is no signature if one of the input files does not exist
+    """
+    create_files(tmp_path, ["sub-001_T2w.nii.gz", "sub-001_T2w_lesion.nii.gz"])
+    fname = str(tmp_path / "sub-001_T2w.nii.gz")
+
+    # Missing label
+    assert get_qc_signature(fname, str(tmp_path / "sub-001_T2w_seg.nii.gz"), 'FILES_SEG', 'sagittal',
+                            SUFFIX_DICT) is None
+    # Missing SC segmentation for the lesion QC
+    assert get_qc_signature(fname, str(tmp_path / "sub-001_T2w_lesion.nii.gz"), 'FILES_LESION', 'sagittal',
+                            SUFFIX_DICT) is None
+
+
+def test_is_qc_report_present(tmp_path):
+    """
+    Test that the QC report is considered present only if its folder exists and is not empty
+    """
+    fname_qc = str(tmp_path / "qc_corr")
+    fname = "/home/user/data_processed/sub-001/anat/sub-001_T2w.nii.gz"
+    path_report = get_qc_report_folder(fname, fname_qc, 'sub-001', 'FILES_SEG')
+    assert path_report == os.path.join(fname_qc, 'data_processed', 'sub-001', 'anat', 'sct_deepseg_sc')
+
+    # Report folder does not exist (e.g., deleted by the user)
+    assert not is_qc_report_present(path_report)
+    # Report folder is empty
+    os.makedirs(path_report)
+    assert not is_qc_report_present(path_report)
+    # Report folder contains a report
+    os.makedirs(os.path.join(path_report, '2024_01_01_120000'))
+    assert is_qc_report_present(path_report)
@@ -7,12 +7,18 @@
 #######################################################################
 
 import os
+import zipfile
+import argparse
+
+import pytest
 
 import numpy as np
 import nibabel as nib
 
 from utils import fetch_subject_and_session, add_suffix, remove_suffix, splitext, curate_dict_yml, get_full_path, \
-    check_files_exist, fetch_yaml_config, track_corrections, get_orientation, change_orientation
+    check_files_exist, fetch_yaml_config, track_corrections, get_orientation, change_orientation, find_files, \
+    find_bids_files, list_files, copy_labels_to_derivatives, is_label_empty, \
+    binarize_label, get_image_intensities, zip_folder, copy_file, positive_int
 
 
 def test_fetch_subject_and_session():
@@ -88,6 +94,54 @@ def test_remove_suffix():
     assert remove_suffix('anat/sub-001_ses-01_T1w_seg.nii.gz', '_seg') == 'anat/sub-001_ses-01_T1w.nii.gz'
 
 
+def test_find_files(tmp_path):
+    """
+    Test that the find_files function recursively finds files with the given suffix and skips hidden folders
+    """
+    path_data = tmp_path / "BIDS"
+    os.makedirs(path_data / "sub-001" / "ses-01" / "anat", exist_ok=True)
+    os.makedirs(path_data / ".git" / "annex", exist_ok=True)
+    open(path_data / "sub-001" / "ses-01" / "anat" / "sub-001_ses-01_T1w.nii.gz", "w").close()
+    open(path_data / "sub-001" / "ses-01" / "anat" / "sub-001_ses-01_T1w_seg.nii.gz", "w").close()
+    open(path_data / "sub-001" / "ses-01" / "anat" / "sub-001_ses-01_T1w.json", "w").close()
+    open(path_data / ".git" / "annex" / "sub-001_ses-01_T1w.nii.gz", "w").close()
+
+    assert sorted(find_files(str(path_data))) == \
+           [str(path_data / "sub-001" / "ses-01" / "anat" / "sub-001_ses-01_T1w.nii.gz"),
+            str(path_data / "sub-001" / "ses-01" / "anat" / "sub-001_ses-01_T1w_seg.nii.gz")]
+    assert list(find_files(str(path_data), '_seg.nii.gz')) == \
+           [str(path_data / "sub-001" / "ses-01" / "anat" / "sub-001_ses-01_T1w_seg.nii.gz")]
+
+
+def test_find_bids_files(tmp_path):
+    """
+    Test that the find_bids_files function finds files only within the BIDS layout (with and without session)
+    """
+    path_data = tmp_path / "BIDS"
+    os.makedirs(path_data / "sub-001" / "ses-01" / "anat", exist_ok=True)
+    os.makedirs(path_data / "sub-002" / "dwi", exist_ok=True)
+    os.makedirs(path_data / "sourcedata" / "sub-001" / "anat", exist_ok=True)
+    open(path_data / "sub-001" / "ses-01" / "anat" / "sub-001_ses-01_T1w.nii.gz", "w").close()
+    open(path_data / "sub-002" / "dwi" / "sub-002_dwi.nii.gz", "w").close()
+    open(path_data / "sub-002" / "dwi" / "sub-002_dwi.json", "w").close()
+    open(path_data / "sourcedata" / "sub-001" / "anat" / "sub-001_T1w.nii.gz", "w").close()
+
+    assert list(find_bids_files(str(path_data))) == \
+           [str(path_data / "sub-001" / "ses-01" / "anat" / "sub-001_ses-01_T1w.nii.gz"),
+            str(path_data / "sub-002" / "dwi" / "sub-002_dwi.nii.gz")]
+
+
+def test_list_files(tmp_path):
+    """
+    Test that the list_files function returns only files (not folders) and handles non-existing folders
+    """
+    os.makedirs(tmp_path / "anat", exist_ok=True)
+    open(tmp_path / "sub-001_T1w.nii.gz", "w").close()
+
+    assert list_files(str(tmp_path)) == {"sub-001_T1w.nii.gz"}
+    assert list_files(str(tmp_path / "dwi")) == set()
+
+
 def test_curate_dict_yml():
     """
     Test that the curate_dict_yml function returns the expected output dictionary
@@ -204,6 +258,55 @@ def test_track_corrections(tmp_path):
     assert dict_files_updated == dict_files_test
 
 
+def test_copy_file(tmp_path):
+    """
+    Test that the copy_file function copies the content of the file
+    """
+    fname_in = tmp_path / "sub-001_T2w_seg.nii.gz"
+    fname_in.write_bytes(os.urandom(100000))
+    fname_out = tmp_path / "sub-001_T2w_seg-manual.nii.gz"
+    # Existing destination file is overwritten
+    fname_out.write_bytes(b"old content, longer than nothing")
+
+    copy_file(str(fname_in), str(fname_out))
+
+    assert fname_out.read_bytes() == fname_in.read_bytes()
+
+
+def test_copy_file_incomplete_copy_file_range(tmp_path, monkeypatch):
+    """
+    Test that copy_file falls back to a regular copy if os.copy_file_range stops before the end of the file
+    """
+    fname_in = tmp_path / "sub-001_T2w_seg.nii.gz"
+    fname_in.write_bytes(os.urandom(100000))
+    fname_out = tmp_path / "sub-001_T2w_seg-manual.nii.gz"
+    # copy_file_range returning 0 means "nothing copied" (e.g., on some FUSE/NFS file systems)
+    monkeypatch.setattr(os, "copy_file_range", lambda *args: 0, raising=False)
+
+    copy_file(str(fname_in), str(fname_out))
+
+    assert fname_out.read_bytes() == fname_in.read_bytes()
+
+
+def test_copy_labels_to_derivatives(tmp_path):
+    """
+    Test that the copy_labels_to_derivatives function copies labels and their JSON sidecars to the output folder
+    """
+    path_in = tmp_path / "labels"
+    path_out = tmp_path / "derivatives" / "labels"
+    os.makedirs(path_in / "sub-001" / "ses-01" / "anat", exist_ok=True)
+    os.makedirs(path_out, exist_ok=True)
+    open(path_in / "sub-001" / "ses-01" / "anat" / "sub-001_ses-01_T1w_seg.nii.gz", "w").close()
+    open(path_in / "sub-001" / "ses-01" / "anat" / "sub-001_ses-01_T1w_seg.json", "w").close()
+    open(path_in / "sub-001" / "ses-01" / "anat" / "sub-001_ses-01_T2w_seg.nii.gz", "w").close()
+
+    copy_labels_to_derivatives(str(path_in), str(path_out), jobs=2)
+
+    path_anat_out = path_out / "sub-001" / "ses-01" / "anat"
+    assert sorted(os.listdir(path_anat_out)) == ["sub-001_ses-01_T1w_seg.json", "sub-001_ses-01_T1w_seg.nii.gz",
+                                                 "sub-001_ses-01_T2w_seg.nii.gz"]
+
+
 def create_dummy_nii_file(tmp_path, filename):
     """
     Create a dummy nifti file for testing purposes
@@ -255,3 +358,88 @@ def test_change_orientation(tmp_path):
 
     # Assert that the orientation is correct
     assert orientation == "AIL"
+
+
+def test_is_label_empty(tmp_path):
+    """
+    Test that the is_label_empty function detects empty and non-empty labels
+    """
+    data = np.zeros((10, 10, 10), dtype=np.uint8)
+    fname_empty = str(tmp_path / "sub-001_T1w_label-disc.nii.gz")
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fname_empty)
+    # Non-zero voxel in the last slice
+    data[5, 5, 9] = 1
+    fname_label = str(tmp_path / "sub-002_T1w_label-disc.nii.gz")
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fname_label)
+
+    assert is_label_empty(fname_empty)
+    assert not is_label_empty(fname_label)
+
+
+def test_get_image_intensities(tmp_path):
+    """
+    Test that get_image_intensities returns min/max intensities and reads the image again once it is modified
+    """
+    fname = str(tmp_path / "sub-001_T2w.nii.gz")
+    data = np.arange(1000, dtype=np.int16).reshape((10, 10, 10))
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fname)
+    assert get_image_intensities(fname) == (0.0, 999.0)
+
+    nib.save(nib.Nifti1Image(data * 2, np.eye(4)), fname)
+    os.utime(fname, ns=(0, 0))
+    assert get_image_intensities(fname) == (0.0, 1998.0)
+
+
+def test_binarize_label(tmp_path):
+    """
+    Test that the binarize_label function sets voxels above the threshold to 1 and other voxels to 0
+    """
+    data = np.zeros((10, 10, 10))
+    data[2, 2, 2] = 0.4
+    data[5, 5, 5] = 3
+    data[7, 7, 7] = -1
+    fname_label = str(tmp_path / "sub-001_T2w_lesion.nii.gz")
+    fname_label_bin = str(tmp_path / "sub-001_T2w_lesion_bin.nii.gz")
+    nib.save(nib.Nifti1Image(data, np.eye(4)), fname_label)
+
+    binarize_label(fname_label, fname_label_bin)
+
+    img_bin = nib.load(fname_label_bin)
+    data_bin = np.asanyarray(img_bin.dataobj)
+    assert img_bin.get_data_dtype() == np.uint8
+    assert np.array_equal(np.argwhere(data_bin), [[2, 2, 2], [5, 5, 5]])
+    assert data_bin.max() == 1
+
+
+def test_zip_folder(tmp_path):
+    """
+    Test that the zip_folder function archives all files of the folder, storing the already compressed files as is
+    """
+    path_folder = tmp_path / "qc"
+    (path_folder / "sub-001" / "anat").mkdir(parents=True)
+    (path_folder / "index.html").write_text("<html></html>" * 100)
+    (path_folder / "sub-001" / "anat" / "img.png").write_bytes(os.urandom(1000))
+    fname_zip = zip_folder(str(path_folder), str(tmp_path / "qc.zip"))
+
+    with zipfile.ZipFile(fname_zip) as zf:
+        assert sorted(zf.namelist()) == ["index.html", "sub-001/anat/img.png"]
+        assert zf.getinfo("index.html").compress_type == zipfile.ZIP_DEFLATED
+        assert zf.getinfo("sub-001/anat/img.png").compress_type == zipfile.ZIP_STORED
+        assert zf.read("index.html") == b"<html></html>" * 100
+
+    # Additional file added at the root of the archive, replacing the file with the same name in the folder
+    (path_folder / "config.yml").write_text("old")
+    fname_config = tmp_path / "config.yml"
+    fname_config.write_text("new")
+    zip_folder(str(path_folder), fname_zip, fnames_extra=[str(fname_config)])
+    with zipfile.ZipFile(fname_zip) as zf:
+        assert sorted(zf.namelist()) == ["config.yml", "index.html", "sub-001/anat/img.png"]
+        assert zf.read("config.yml") == b"new"
+
+
+def test_positive_int():
+    assert positive_int('1') == 1
+    assert positive_int('16') == 16
+    for value in ['0', '-2', 'a', '1.5', '']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            positive_int(value)
@@ -8,23 +8,47 @@
 
 import os
 import re
+import functools
 import logging
 import sys
 import textwrap
 import argparse
 import subprocess
 import shutil
+import zipfile
 import yaml
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy as np
-import nibabel as nib
+# Note: numpy and nibabel are imported in the functions that need them, because importing nibabel takes a significant
+# part of the startup time (e.g., '-h', or '-qc-only' without any label check)
+
+# Use the libyaml-based (C) loader and dumper if available, they are much faster than the pure-Python ones
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+
+# Extensions of files that are already compressed (they are stored as is in zip archives, re-compressing them would
+# only cost CPU time)
+COMPRESSED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.gz', '.zip')
+
+
+# Regular expressions used to fetch BIDS entities from file names/paths; [_/] means either underscore or slash
+# REGEX explanation
+# . - match any character (except newline)
+# *? - match the previous element as few times as possible (zero or more times)
+REGEX_SUBJECT = re.compile('sub-(.*?)[_/]')
+REGEX_SESSION = re.compile('ses-(.*?)[_/]')
 
 
 # BIDS utility tool
+@functools.lru_cache(maxsize=None)
 def fetch_subject_and_session(filename_path):
     """
     Get subject ID, session ID and filename from the input BIDS-compatible filename or file path
     The function works both on absolute file path as well as filename
+    Note: the results are cached because the function is called several times for the same path
     :param filename_path: input nifti filename (e.g., sub-001_ses-01_T1w.nii.gz) or file path
     (e.g., /home/user/MRI/bids/derivatives/labels/sub-001/ses-01/anat/sub-001_ses-01_T1w.nii.gz
     :return: subjectID: subject ID (e.g., sub-001)
@@ -33,14 +57,11 @@ def fetch_subject_and_session(filename_path):
     """
 
     _, filename = os.path.split(filename_path)              # Get just the filename (i.e., remove the path)
-    subject = re.search('sub-(.*?)[_/]', filename_path)     # [_/] means either underscore or slash
+    subject = REGEX_SUBJECT.search(filename_path)
     subjectID = subject.group(0)[:-1] if subject else ""    # [:-1] removes the last underscore or slash
 
-    session = re.search('ses-(.*?)[_/]', filename_path)     # [_/] means either underscore or slash
+    session = REGEX_SESSION.search(filename_path)
     sessionID = session.group(0)[:-1] if session else ""    # [:-1] removes the last underscore or slash
-    # REGEX explanation
-    # . - match any character (except newline)
-    # *? - match the previous element as few times as possible (zero or more times)
 
     # TODO - add support for func (fMRI)
     contrast = 'dwi' if 'dwi' in filename_path else 'anat'  # Return contrast (dwi or anat)
@@ -48,6 +69,22 @@ def fetch_subject_and_session(filename_path):
     return subjectID, sessionID, filename, contrast
 
 
+def positive_int(value):
+    """
+    Argparse type for the flags that require a strictly positive integer (e.g., number of parallel jobs), so that a wrong
+    value is reported when parsing the arguments
+    :param value: str: value passed to the flag
+    :return: int: input value
+    """
+    try:
+        value_int = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid positive integer: '{value}'")
+    if value_int < 1:
+        raise argparse.ArgumentTypeError(f"invalid positive integer: '{value}'. The value must be at least 1")
+    return value_int
+
+
 class SmartFormatter(argparse.HelpFormatter):
     """
     Custom formatter that inherits from HelpFormatter, which adjusts the default width to the current Terminal size,
@@ -153,6 +190,59 @@ def remove_suffix(fname, suffix):
     return os.path.join(stem.replace(suffix, '') + ext)
 
 
+def find_files(path_root, suffix='.nii.gz'):
+    """
+    Recursively find files ending with the given suffix. Faster alternative to
+    sorted(glob.glob(path_root + '/**/*' + suffix, recursive=True)): each folder is listed only once using os.scandir
+    and no extra stat call is needed per file.
+    Files are yielded while walking the folders (in alphabetical order within each folder), so that the results can be
+    processed before the whole tree is listed.
+    Note: similarly to glob, hidden files and folders (e.g., .git) are skipped.
+    :param path_root: str: folder to search in
+    :param suffix: str: file suffix, e.g., '.nii.gz' or '_seg.nii.gz'
+    :return: generator of file paths
+    """
+    with os.scandir(path_root) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir():
+            yield from find_files(entry.path, suffix)
+        elif entry.name.endswith(suffix):
+            yield entry.path
+
+
+def find_bids_files(path_root, suffix='.nii.gz'):
+    """
+    Find files ending with the given suffix in a BIDS-compliant folder. Contrary to find_files, only the BIDS layout
+    (sub-*/[ses-*/]<datatype>/) is walked, i.e., other folders such as 'sourcedata', 'code' or 'derivatives' are not
+    listed at all.
+    :param path_root: str: BIDS-compliant folder, e.g., ~/<your_dataset>/derivatives/labels
+    :param suffix: str: file suffix, e.g., '.nii.gz' or '_seg.nii.gz'
+    :return: generator of file paths (in alphabetical order)
+    """
+    def _scandir_sorted(path_folder):
+        with os.scandir(path_folder) as it:
+            return sorted((entry for entry in it if not entry.name.startswith('.')), key=lambda entry: entry.name)
+
+    for entry_subject in _scandir_sorted(path_root):
+        if not (entry_subject.name.startswith('sub-') and entry_subject.is_dir()):
+            continue
+        for entry in _scandir_sorted(entry_subject.path):
+            if not entry.is_dir():
+                continue
+            # Session is optional in BIDS
+            if entry.name.startswith('ses-'):
+                entries_datatype = [e for e in _scandir_sorted(entry.path) if e.is_dir()]
+            else:
+                entries_datatype = [entry]
+            for entry_datatype in entries_datatype:
+                for entry_file in _scandir_sorted(entry_datatype.path):
+                    if entry_file.name.endswith(suffix) and entry_file.is_file():
+                        yield entry_file.path
+
+
 def fetch_yaml_config(config_file):
     """
     Fetch configuration from YAML file
@@ -169,7 +259,7 @@ def fetch_yaml_config(config_file):
     # Fetch input yml file as dict
     with open(fname_yml, 'r') as stream:
         try:
-            dict_yml = yaml.safe_load(stream)
+            dict_yml = yaml.load(stream, Loader=SafeLoader)
         except yaml.YAMLError as exc:
             print(exc)
 
@@ -197,6 +287,21 @@ def get_full_path(path):
     return os.path.abspath(os.path.expanduser(path))
 
 
+def list_files(path_folder):
+    """
+    List files in a folder using a single os.scandir call (instead of one stat call per file).
+    Note: broken symlinks (e.g., git-annex files whose content is not present) are not listed, similarly to
+    os.path.exists.
+    :param path_folder: str: path to the folder
+    :return: set: names of the files in the folder (empty if the folder does not exist)
+    """
+    try:
+        with os.scandir(path_folder) as it:
+            return {entry.name for entry in it if entry.is_file()}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
 def check_files_exist(dict_yml, path_img, path_label, suffix_dict):
     """
     Check if the files listed in the input config yml file
@@ -210,6 +315,15 @@ def check_files_exist(dict_yml, path_img, path_label, suffix_dict):
     missing_files = []
     missing_files_labels = []
     missing_suffixes = set()
+    # Content of the already listed folders; each folder is listed only once
+    folder_content = {}
+
+    def _exists(fname):
+        path_folder, filename = os.path.split(fname)
+        if path_folder not in folder_content:
+            folder_content[path_folder] = list_files(path_folder)
+        return filename in folder_content[path_folder]
+
     for task, files in dict_yml.items():
         if task.startswith('FILES') and files:
             # Check if task is in suffix_dict.keys(), if not, skip it
@@ -221,12 +335,12 @@ def check_files_exist(dict_yml, path_img, path_label, suffix_dict):
                 for file in files:
                     subject, ses, filename, contrast = fetch_subject_and_session(file)
                     fname = os.path.join(path_img, subject, ses, contrast, filename)
-                    if not os.path.exists(fname):
+                    if not _exists(fname):
                         missing_files.append(fname)
                     # Construct absolute path to the input label (segmentation, labeling etc.) file
                     # For example: '/Users/user/dataset/data_processed/sub-001/anat/sub-001_T2w_seg.nii.gz'
                     fname_label = add_suffix(os.path.join(path_label, subject, ses, contrast, filename), suffix_dict[task])
-                    if not os.path.exists(fname_label):
+                    if not _exists(fname_label):
                         missing_files_labels.append(fname_label)
                         missing_suffixes.add(suffix_dict[task])
     if missing_files:
@@ -253,6 +367,46 @@ def check_output_folder(path_bids):
         os.makedirs(path_bids, exist_ok=True)
 
 
+def get_env_threads(n_threads, override=False):
+    """
+    Get a copy of the environment variables limiting the number of threads used by a subprocess (ITK, OpenMP,
+    OpenBLAS, MKL). This avoids oversubscription of the CPU when several subprocesses (e.g., 'sct_qc') run in parallel.
+    :param n_threads: int: number of threads per subprocess
+    :param override: bool: if False, variables already set by the user are kept
+    :return: dict: environment variables to pass to the subprocess
+    """
+    env = os.environ.copy()
+    for var in ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        if override or var not in env:
+            env[var] = str(n_threads)
+    return env
+
+
+def run_command(cmd, env=None):
+    """
+    Run a command without printing its standard output (e.g., for commands running in the background, whose output
+    would be interleaved with the output of the manual corrections). If the command fails, its error output is logged
+    and subprocess.CalledProcessError is raised.
+    :param cmd: list: command and its arguments, e.g., ['sct_qc', '-i', 'sub-001_T2w.nii.gz', ...]
+    :param env: dict: environment variables for the command (default: None, i.e., the current environment)
+    """
+    try:
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env, check=True)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Command '{' '.join(cmd)}' failed:\n{e.stderr.decode(errors='replace')}")
+        raise
+
+
+@functools.lru_cache(maxsize=None)
+def which(cmd):
+    """
+    Cached version of shutil.which: the $PATH is searched only once per command (viewers are checked for every file).
+    :param cmd: str: command, e.g., 'fsleyes'
+    :return: str: path to the command, or None if the command is not found
+    """
+    return shutil.which(cmd)
+
+
 def check_software_installed(list_software=['sct']):
     """
     Make sure software are installed
@@ -261,12 +415,12 @@ def check_software_installed(list_software=['sct']):
     """
     install_ok = True
     software_cmd = {
-        'sct': 'sct_version'
+        'sct': ['sct_version']
         }
     logging.info("Checking if required software are installed...")
     for software in list_software:
         try:
-            output = subprocess.check_output(software_cmd[software], shell=True)
+            output = subprocess.check_output(software_cmd[software])
             logging.info("'{}' (version: {}) is installed.".format(software, output.decode('utf-8').strip('\n')))
         except:
             logging.error("'{}' is not installed. Please install it before using this program.".format(software))
@@ -274,40 +428,105 @@ def check_software_installed(list_software=['sct']):
     return install_ok
 
 
-def get_image_intensities(fname_image):
+@functools.lru_cache(maxsize=256)
+def compute_image_intensities(fname_image, mtime_ns, size):
     """
-    Get min and max intensities for input nifti image
+    Compute min and max intensities for input nifti image. The result is cached; the modification time and size of the
+    file are part of the cache key, so that a modified image is read again. Use get_image_intensities instead of calling
+    this function directly.
     :param fname_image: str: input nifti image
-    :return: min_intensity: float64: minimum intensity of input image
-    :return: max_intensity: float64: maximum intensity of input image
+    :param mtime_ns: int: modification time of the image (in nanoseconds)
+    :param size: int: size of the image (in bytes)
+    :return: min_intensity: float: minimum intensity of input image
+    :return: max_intensity: float: maximum intensity of input image
     """
+    import numpy as np
+    import nibabel as nib
+
     # Load nii image
-    image = nib.load(fname_image)
+    # Note: dataobj keeps the on-disk dtype (get_fdata would upcast the whole volume to float64)
+    data = np.asanyarray(nib.load(fname_image).dataobj)
     # Get min intensity
-    min_intensity = np.min(image.get_fdata())
+    min_intensity = float(np.min(data))
     # Get max intensity
-    max_intensity = np.max(image.get_fdata())
+    max_intensity = float(np.max(data))
 
     return min_intensity, max_intensity
 
 
+def get_image_intensities(fname_image):
+    """
+    Get min and max intensities for input nifti image. An unchanged image is read only once per run (e.g., when it is
+    listed under several tasks).
+    :param fname_image: str: input nifti image
+    :return: min_intensity: float: minimum intensity of input image
+    :return: max_intensity: float: maximum intensity of input image
+    """
+    stat = os.stat(fname_image)
+    return compute_image_intensities(fname_image, stat.st_mtime_ns, stat.st_size)
+
+
+def is_label_empty(fname_label):
+    """
+    Check if the input label file is empty (i.e., contains only zeros).
+    The label is read slice by slice (along the last axis) and the reading stops at the first non-zero slice, so the
+    whole volume is never loaded in memory.
+    :param fname_label: str: path to the label file
+    :return: bool: True if the label is empty
+    """
+    import numpy as np
+    import nibabel as nib
+
+    # keep_file_open=True: the (gzip) file is kept open between slices, so that it is decompressed only once
+    proxy = nib.load(fname_label, keep_file_open=True).dataobj
+    for z in range(proxy.shape[-1]):
+        if np.any(proxy[..., z]):
+            return False
+    return True
+
+
 def create_empty_mask(fname, fname_label):
     """
     Create empty mask from reference image
     :param fname: absolute path to reference image
     :param fname_label: absolute path to output mask under derivatives
     """
+    import numpy as np
+    import nibabel as nib
+
     img = nib.load(fname)
-    data = np.zeros(img.shape)
-    img_mask = nib.Nifti1Image(data, affine=img.affine, header=img.header)
+    # Note: the mask is saved as uint8 (labels are integers, no need for float64)
+    data = np.zeros(img.shape, dtype=np.uint8)
+    header = img.header.copy()
+    header.set_data_dtype(np.uint8)
+    img_mask = nib.Nifti1Image(data, affine=img.affine, header=header)
     nib.save(img_mask, fname_label)
     print("No label file found, creating an empty mask: {}".format(fname_label))
 
 
+def binarize_label(fname_label, fname_label_bin, threshold=0):
+    """
+    Binarize label file (equivalent of 'sct_maths -bin', but without the overhead of launching a SCT subprocess).
+    :param fname_label: absolute path to the input label file
+    :param fname_label_bin: absolute path to the output binarized label file
+    :param threshold: voxels with a value above this threshold are set to 1, others to 0
+    """
+    import numpy as np
+    import nibabel as nib
+
+    img = nib.load(fname_label)
+    data_bin = (np.asanyarray(img.dataobj) > threshold).astype(np.uint8)
+    header = img.header.copy()
+    header.set_data_dtype(np.uint8)
+    img_bin = nib.Nifti1Image(data_bin, affine=img.affine, header=header)
+    nib.save(img_bin, fname_label_bin)
+
+
 def track_corrections(files_dict, config_path, file_path, task):
     """
     Keep track of corrected files by moving corrected subjects from FILES_{task} to CORR_{task}.
-    Note: the function does modify the YML config file.
+    Note: the function does modify the YML config file (unless config_path is None, in which case only files_dict is
+    updated and write_yaml_config must be called later).
     :param files_dict: dict with all the subjects
     :param config_path: path to config YAML file listing images that require manual corrections
     :param file_path: path to the last corrected image
@@ -327,11 +546,143 @@ def track_corrections(files_dict, config_path, file_path, task):
     files_dict[task] = [file for file in files_dict[task] if filename not in file]
 
     # Update YAML file
-    yaml.dump(files_dict, open(config_path, 'w'))
+    if config_path is not None:
+        write_yaml_config(files_dict, config_path)
 
     return files_dict
 
 
+def write_yaml_config(files_dict, config_path):
+    """
+    Write the config YAML file.
+    :param files_dict: dict with all the subjects
+    :param config_path: path to config YAML file
+    """
+    with open(config_path, 'w') as f:
+        yaml.dump(files_dict, f, Dumper=SafeDumper)
+
+
+def copy_file(fname_in, fname_out):
+    """
+    Copy file and return a message describing the copy
+    :param fname_in: path to the source file
+    :param fname_out: path to the destination file
+    :return: str: message to print
+    """
+    # Note: hard links are not used because the copied labels are then modified in place (viewers, reorientation),
+    # which would also modify the source file
+    if hasattr(os, 'copy_file_range'):
+        try:
+            copy_file_range(fname_in, fname_out)
+            return f'Copying: {fname_in} to {fname_out}'
+        except OSError:
+            # E.g., not supported by the kernel or across file systems --> fall back to shutil.copyfile
+            pass
+    # Note: we use copyfile instead of copy because the permission bits of the source file are not needed in
+    # derivatives (copy would call additional stat and chmod for each file)
+    shutil.copyfile(fname_in, fname_out)
+    return f'Copying: {fname_in} to {fname_out}'
+
+
+def copy_file_range(fname_in, fname_out):
+    """
+    Copy file using os.copy_file_range (Linux only). The data is copied by the kernel, and on file systems supporting
+    it (e.g., Btrfs, XFS), the copy is a reflink (i.e., the data blocks are shared until one of the files is modified).
+    :param fname_in: path to the source file
+    :param fname_out: path to the destination file
+    Note: OSError is raised if the file could not be copied entirely (e.g., copy_file_range returning 0 too early on
+    some FUSE/NFS file systems), so that the caller never ends up with a truncated copy.
+    """
+    with open(fname_in, 'rb') as f_in, open(fname_out, 'wb') as f_out:
+        size = os.fstat(f_in.fileno()).st_size
+        copied = 0
+        while copied < size:
+            n = os.copy_file_range(f_in.fileno(), f_out.fileno(), size - copied)
+            if n == 0:
+                break
+            copied += n
+    if copied < size:
+        raise OSError(f"copy_file_range copied only {copied} of {size} bytes from {fname_in} to {fname_out}")
+
+
+def zip_folder(path_folder, fname_zip, fnames_extra=()):
+    """
+    Zip the content of a folder (equivalent of shutil.make_archive(..., 'zip', path_folder)). Already compressed files
+    (e.g., PNG images) are stored without compression, other files (e.g., HTML, JSON) are compressed with the fastest
+    compression level.
+    Note: hidden files (e.g., '.qc_cache.json') are not archived.
+    :param path_folder: str: path to the folder to zip
+    :param fname_zip: str: path to the output zip file
+    :param fnames_extra: list: additional files to add at the root of the archive (without copying them to the folder)
+    :return: str: path to the output zip file
+    """
+    def _write(zf, path_file, arcname):
+        if path_file.lower().endswith(COMPRESSED_EXTENSIONS):
+            zf.write(path_file, arcname, compress_type=zipfile.ZIP_STORED)
+        else:
+            zf.write(path_file, arcname, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+
+    arcnames_extra = {os.path.basename(fname) for fname in fnames_extra}
+    with zipfile.ZipFile(fname_zip, 'w') as zf:
+        for root, dirs, files in os.walk(path_folder):
+            dirs.sort()
+            for file in sorted(files):
+                if file.startswith('.'):
+                    continue
+                path_file = os.path.join(root, file)
+                arcname = os.path.relpath(path_file, path_folder)
+                # Skip files replaced by the additional files (e.g., a copy left by a previous run)
+                if arcname in arcnames_extra:
+                    continue
+                _write(zf, path_file, arcname)
+        for fname in fnames_extra:
+            _write(zf, fname, os.path.basename(fname))
+    return fname_zip
+
+
+def copy_labels_to_derivatives(path_in, path_out, jobs=16):
+    """
+    Copy labels (nii.gz files and their JSON sidecars) from a BIDS-compliant folder to another BIDS-compliant folder
+    (typically the dataset's derivatives/labels folder).
+    Files are copied in parallel (copying is I/O-bound, so threads are sufficient), and the copy starts while the input
+    folder is still being listed. Copy messages are printed from the main thread, once all files are copied.
+    :param path_in: str: path to the BIDS-compliant folder with labels
+    :param path_out: str: path to the BIDS-compliant folder where the labels will be copied
+    :param jobs: int: number of files copied in parallel
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        # Output folders already checked/created (the same folder is typically shared by many files)
+        folders_out = set()
+        # Loop across files in input folder (only the BIDS layout sub-*/[ses-*/]<datatype>/ is walked)
+        for path_file_in in find_bids_files(path_in, '.nii.gz'):
+            sub, ses, filename, contrast = fetch_subject_and_session(path_file_in)
+            # Construct path for the output file
+            path_file_out = os.path.join(path_out, sub, ses, contrast, filename)
+            # Check if subject's folder exists in the output dataset, if not, create it
+            path_subject_folder_out = os.path.join(path_out, sub, ses, contrast)
+            if path_subject_folder_out not in folders_out:
+                if not os.path.isdir(path_subject_folder_out):
+                    os.makedirs(path_subject_folder_out)
+                    print(f'Creating directory: {path_subject_folder_out}')
+                folders_out.add(path_subject_folder_out)
+            # Copy nii and json files to the output dataset
+            # TODO - consider rsync instead of shutil.copyfile
+            futures.append(executor.submit(copy_file, path_file_in, path_file_out))
+            # Note: all found files end with '.nii.gz', so we can simply swap the extension
+            path_file_json_in = path_file_in[:-len('.nii.gz')] + '.json'
+            path_file_json_out = path_file_out[:-len('.nii.gz')] + '.json'
+            if os.path.isfile(path_file_json_in):
+                futures.append(executor.submit(copy_file, path_file_json_in, path_file_json_out))
+            else:
+                print(f'Warning: {path_file_json_in} does not exist.')
+
+        # Print all messages at once (one write instead of one per copied file)
+        messages = [future.result() for future in futures]
+        if messages:
+            print('\n'.join(messages))
+
+
 def get_orientation(file_path):
     """
     Get the orientation of the input nifti file
@@ -361,14 +712,16 @@ def get_orientation(file_path):
     return orientation
 
 
-def change_orientation(file_path, orientation):
+def change_orientation(file_path, orientation, file_path_out=None):
     """
     Change the orientation of the input nifti file
     :param file_path: path to the nifti file
     :param orientation: desired orientation of the nifti file, e.g., 'RPI'
+    :param file_path_out: path to the output nifti file (default: None, i.e., the input file is overwritten)
     """
+    if file_path_out is None:
+        file_path_out = file_path
 
     # Change the orientation of the input nifti file
-    # Note: The image is currently being overwritten
-    subprocess.run(['sct_image', '-i', file_path, '-setorient', orientation, '-o', file_path], capture_output=True)
-    print(f"Orientation of {file_path} has been changed to {orientation}")
+    subprocess.run(['sct_image', '-i', file_path, '-setorient', orientation, '-o', file_path_out], capture_output=True)
+    print(f"Orientation of {file_path_out} has been changed to {orientation}")